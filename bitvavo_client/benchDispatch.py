@@ -0,0 +1,157 @@
+import time
+import json
+from bitvavo_client.bitvavo import Bitvavo, debugToConsole, errorToConsole, loads
+
+"""
+* Micro-benchmark for websocket message dispatch.
+* Compares the previous if/elif dispatch (stdlib json, eager debug formatting)
+* with the table-driven Bitvavo.websocket.on_message.
+* Run from the repository root: python -m bitvavo_client.benchDispatch
+"""
+
+# The dispatch as it was before the action/event tables, kept for comparison.
+def legacyOnMessage(self, ws, msg):
+  debugToConsole('RECEIVED: ' + msg)
+  msg = json.loads(msg)
+  callbacks = self.callbacks
+
+  if 'error' in msg:
+    if msg['errorCode'] == 105:
+      self.bitvavo.updateRateLimit(msg)
+    if 'error' in callbacks:
+      callbacks['error'](msg)
+    else:
+      errorToConsole(json.dumps(msg, indent=2))
+
+  if 'action' in msg:
+    if(msg['action'] == 'getTime'):
+      callbacks['time'](msg['response'])
+    elif(msg['action'] == 'getMarkets'):
+      callbacks['markets'](msg['response'])
+    elif(msg['action'] == 'getAssets'):
+      callbacks['assets'](msg['response'])
+    elif(msg['action'] == 'getTrades'):
+      callbacks['publicTrades'](msg['response'])
+    elif(msg['action'] == 'getCandles'):
+      callbacks['candles'](msg['response'])
+    elif(msg['action'] == 'getTicker24h'):
+      callbacks['ticker24h'](msg['response'])
+    elif(msg['action'] == 'getTickerPrice'):
+      callbacks['tickerPrice'](msg['response'])
+    elif(msg['action'] == 'getTickerBook'):
+      callbacks['tickerBook'](msg['response'])
+    elif(msg['action'] == 'privateCreateOrder'):
+      callbacks['placeOrder'](msg['response'])
+    elif(msg['action'] == 'privateUpdateOrder'):
+      callbacks['updateOrder'](msg['response'])
+    elif(msg['action'] == 'privateGetOrder'):
+      callbacks['getOrder'](msg['response'])
+    elif(msg['action'] == 'privateCancelOrder'):
+      callbacks['cancelOrder'](msg['response'])
+    elif(msg['action'] == 'privateGetOrders'):
+      callbacks['getOrders'](msg['response'])
+    elif(msg['action'] == 'privateGetOrdersOpen'):
+      callbacks['ordersOpen'](msg['response'])
+    elif(msg['action'] == 'privateGetTrades'):
+      callbacks['trades'](msg['response'])
+    elif(msg['action'] == 'privateGetAccount'):
+      callbacks['account'](msg['response'])
+    elif(msg['action'] == 'privateGetFees'):
+      callbacks['fees'](msg['response'])
+    elif(msg['action'] == 'privateGetBalance'):
+      callbacks['balance'](msg['response'])
+    elif(msg['action'] == 'privateDepositAssets'):
+      callbacks['depositAssets'](msg['response'])
+    elif(msg['action'] == 'privateWithdrawAssets'):
+      callbacks['withdrawAssets'](msg['response'])
+    elif(msg['action'] == 'privateGetDepositHistory'):
+      callbacks['depositHistory'](msg['response'])
+    elif(msg['action'] == 'privateGetWithdrawalHistory'):
+      callbacks['withdrawalHistory'](msg['response'])
+    elif(msg['action'] == 'privateCancelOrders'):
+      callbacks['cancelOrders'](msg['response'])
+    elif(msg['action'] == 'getBook'):
+      market = msg['response']['market']
+      if('book' in callbacks):
+        callbacks['book'](msg['response'])
+      if(self.keepBookCopy):
+        if(market in callbacks['subscriptionBook']):
+          callbacks['subscriptionBook'][market](self, msg)
+
+  elif('event' in msg):
+    if(msg['event'] == 'authenticate'):
+      self.authenticated = True
+      debugToConsole('Authenticated Websocket.')
+    elif(msg['event'] == 'fill'):
+      market = msg['market']
+      callbacks['subscriptionAccount'][market](msg)
+    elif(msg['event'] == 'order'):
+      market = msg['market']
+      callbacks['subscriptionAccount'][market](msg)
+    elif(msg['event'] == 'ticker'):
+      market = msg['market']
+      if(market in callbacks.get('subscriptionTicker', {})):
+        callbacks['subscriptionTicker'][market](msg)
+    elif(msg['event'] == 'ticker24h'):
+      for entry in msg['data']:
+        callbacks['subscriptionTicker24h'][entry['market']](entry)
+    elif(msg['event'] == 'candle'):
+      market = msg['market']
+      interval = msg['interval']
+      if(interval in callbacks.get('subscriptionCandles', {}).get(market, {})):
+        callbacks['subscriptionCandles'][market][interval](msg)
+    elif(msg['event'] == 'book'):
+      market = msg['market']
+      if('subscriptionBookUpdate' in callbacks):
+        if(market in callbacks['subscriptionBookUpdate']):
+          callbacks['subscriptionBookUpdate'][market](msg)
+      if(self.keepBookCopy):
+        if(market in callbacks['subscriptionBook']):
+          callbacks['subscriptionBook'][market](self, msg)
+    elif(msg['event'] == 'trade'):
+      market = msg['market']
+      if('subscriptionTrades' in callbacks):
+        callbacks['subscriptionTrades'][market](msg)
+
+def makeSocket():
+  # A websocket object with callbacks registered, but without opening a connection.
+  socket = Bitvavo.websocket.__new__(Bitvavo.websocket)
+  socket.initState(None)
+  noop = lambda response: None
+  markets = ['M' + str(i) + '-EUR' for i in range(50)]
+  socket.callbacks['candles'] = noop
+  socket.callbacks['subscriptionTicker'] = { market: noop for market in markets }
+  socket.callbacks['subscriptionTrades'] = { market: noop for market in markets }
+  socket.callbacks['subscriptionBookUpdate'] = { market: noop for market in markets }
+  socket.callbacks['subscriptionCandles'] = { market: { '1m': noop } for market in markets }
+  return socket, markets
+
+def makeMessages(markets):
+  messages = []
+  for i, market in enumerate(markets):
+    messages.append(json.dumps({ 'event': 'ticker', 'market': market, 'bestBid': '1.0' + str(i), 'bestAsk': '1.1', 'lastPrice': '1.05' }))
+    messages.append(json.dumps({ 'event': 'candle', 'market': market, 'interval': '1m', 'candle': [[1700000000000, '1', '2', '0.5', '1.5', '10']] }))
+    messages.append(json.dumps({ 'event': 'book', 'market': market, 'nonce': i, 'bids': [['1.0', '2'], ['0.9', '0']], 'asks': [['1.1', '3']] }))
+    messages.append(json.dumps({ 'event': 'trade', 'market': market, 'id': str(i), 'amount': '1', 'price': '1.05', 'side': 'buy', 'timestamp': 1700000000000 }))
+    messages.append(json.dumps({ 'action': 'getCandles', 'market': market, 'response': [[1700000000000, '1', '2', '0.5', '1.5', '10']] * 5 }))
+  return messages
+
+def measure(handler, socket, messages, rounds):
+  start = time.perf_counter()
+  for _ in range(rounds):
+    for message in messages:
+      handler(socket, None, message)
+  return (rounds * len(messages)) / (time.perf_counter() - start)
+
+def main(rounds=200):
+  socket, markets = makeSocket()
+  messages = makeMessages(markets)
+  before = measure(legacyOnMessage, socket, messages, rounds)
+  after = measure(Bitvavo.websocket.on_message, socket, messages, rounds)
+  parser = 'orjson' if loads is not json.loads else 'json'
+  print('before: ' + str(int(before)) + ' messages/second')
+  print('after:  ' + str(int(after)) + ' messages/second (' + parser + ')')
+  print('speedup: ' + str(round(after / before, 2)) + 'x')
+
+if __name__ == '__main__':
+  main()
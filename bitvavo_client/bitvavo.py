@@ -6,8 +6,49 @@ import json
 import websocket
 import threading
 import datetime
+import bisect
+from collections import deque
+import itertools
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+try:
+  import orjson
+  loads = orjson.loads
+except ImportError:
+  loads = json.loads
 
 debugging = False
+BOOK_BUFFER_SIZE = 10000
+RECONNECT_TIMER = 0.5
+MAX_RECONNECT_TIMER = 60
+HEALTHY_CONNECTION = 30
+
+# Response action -> key of the callback registered by the matching request method.
+ACTION_CALLBACKS = {
+  'getTime': 'time',
+  'getMarkets': 'markets',
+  'getAssets': 'assets',
+  'getTrades': 'publicTrades',
+  'getCandles': 'candles',
+  'getTicker24h': 'ticker24h',
+  'getTickerPrice': 'tickerPrice',
+  'getTickerBook': 'tickerBook',
+  'privateCreateOrder': 'placeOrder',
+  'privateUpdateOrder': 'updateOrder',
+  'privateGetOrder': 'getOrder',
+  'privateCancelOrder': 'cancelOrder',
+  'privateGetOrders': 'getOrders',
+  'privateGetOrdersOpen': 'ordersOpen',
+  'privateGetTrades': 'trades',
+  'privateGetAccount': 'account',
+  'privateGetFees': 'fees',
+  'privateGetBalance': 'balance',
+  'privateDepositAssets': 'depositAssets',
+  'privateWithdrawAssets': 'withdrawAssets',
+  'privateGetDepositHistory': 'depositHistory',
+  'privateGetWithdrawalHistory': 'withdrawalHistory',
+  'privateCancelOrders': 'cancelOrders'
+}
 
 def debugToConsole(message):
   if(debugging):
@@ -39,59 +80,132 @@ def _default(value, fallback):
 def _epoch_millis(dt):
   return int(dt.timestamp() * 1000)
 
-def asksCompare(a, b):
-  if(a < b):
-    return True
-  return False
-
-def bidsCompare(a, b):
-  if(a > b):
-    return True
-  return False
-
-def sortAndInsert(book, update, compareFunc):
-  for updateEntry in update:
-    entrySet = False
-    for j in range(len(book)):
-      bookItem = book[j]
-      if compareFunc(float(updateEntry[0]), float(bookItem[0])):
-        book.insert(j, updateEntry)
-        entrySet = True
-        break
-      if float(updateEntry[0]) == float(bookItem[0]):
-        if float(updateEntry[1]) > 0.0:
-          book[j] = updateEntry
-          entrySet = True
-          break
+class bookSide:
+  # Price levels kept sorted best-first. Keys are the float prices (negated for bids)
+  # so both sides can be searched with bisect; entries keep the original [price, size] pairs.
+  def __init__(self, descending):
+    self.descending = descending
+    self.keys = []
+    self.sizes = []
+    self.entries = []
+
+  def _key(self, price):
+    return -price if self.descending else price
+
+  def load(self, entries):
+    self.keys[:] = [self._key(float(entry[0])) for entry in entries]
+    self.sizes[:] = [float(entry[1]) for entry in entries]
+    self.entries[:] = entries
+
+  def update(self, updates):
+    for entry in updates:
+      key = self._key(float(entry[0]))
+      size = float(entry[1])
+      i = bisect.bisect_left(self.keys, key)
+      found = i < len(self.keys) and self.keys[i] == key
+      if size > 0.0:
+        if found:
+          self.sizes[i] = size
+          self.entries[i] = entry
         else:
-          book.pop(j)
-          entrySet = True
-          break
-    if not entrySet:
-      book.append(updateEntry)
-  return book
+          self.keys.insert(i, key)
+          self.sizes.insert(i, size)
+          self.entries.insert(i, entry)
+      elif found:
+        del self.keys[i]
+        del self.sizes[i]
+        del self.entries[i]
+
+  def bestPrice(self):
+    if len(self.keys) == 0:
+      return None
+    return -self.keys[0] if self.descending else self.keys[0]
+
+  def depth(self, levels):
+    return self.entries[:levels]
+
+  # Total size of the first `levels` levels, or of all levels at or better than `price`.
+  def cumulativeVolume(self, levels=None, price=None):
+    if price is not None:
+      levels = bisect.bisect_right(self.keys, self._key(float(price)))
+    return sum(self.sizes[:levels])
+
+class localOrderBook(dict):
+  # Behaves like the old {'bids', 'asks', 'nonce', 'market'} dict, with fast queries on top.
+  def __init__(self, market):
+    dict.__init__(self)
+    self.bidSide = bookSide(True)
+    self.askSide = bookSide(False)
+    self['market'] = market
+    self['bids'] = self.bidSide.entries
+    self['asks'] = self.askSide.entries
+
+  def load(self, snapshot):
+    self.bidSide.load(snapshot['bids'])
+    self.askSide.load(snapshot['asks'])
+    self['nonce'] = snapshot['nonce']
+
+  def apply(self, update):
+    self.bidSide.update(update['bids'])
+    self.askSide.update(update['asks'])
+    self['nonce'] = update['nonce']
+
+  def bestBid(self):
+    return self.bidSide.bestPrice()
+
+  def bestAsk(self):
+    return self.askSide.bestPrice()
+
+  def spread(self):
+    bid = self.bestBid()
+    ask = self.bestAsk()
+    if bid is None or ask is None:
+      return None
+    return ask - bid
+
+  def depth(self, levels):
+    return { 'bids': self.bidSide.depth(levels), 'asks': self.askSide.depth(levels) }
+
+  def cumulativeVolume(self, side, levels=None, price=None):
+    half = self.bidSide if side == 'bids' else self.askSide
+    return half.cumulativeVolume(levels, price)
 
 def processLocalBook(ws, message):
   if('action' in message):
     if(message['action'] == 'getBook'):
       market = message['response']['market']
-      ws.localBook[market]['bids'] = message['response']['bids']
-      ws.localBook[market]['asks'] = message['response']['asks']
-      ws.localBook[market]['nonce'] = message['response']['nonce']
-      ws.localBook[market]['market'] = market
+      book = ws.localBook[market]
+      book.load(message['response'])
+      # Replay the updates that arrived while the snapshot was in flight.
+      pending = ws.bookBuffer.pop(market, [])
+      for update in pending:
+        if(update['nonce'] <= book['nonce']):
+          continue
+        if(update['nonce'] != book['nonce'] + 1):
+          ws.makeLocalBook(market)
+          return
+        book.apply(update)
   elif('event' in message):
     if(message['event'] == 'book'):
       market = message['market']
-
-      if(message['nonce'] != ws.localBook[market]['nonce'] + 1):
-        ws.makeLocalBook(market, ws.callbacks['localBookUser'][market])
+      if(market in ws.bookBuffer):
+        ws.bookBuffer[market].append(message)
+        return
+      book = ws.localBook[market]
+      if(message['nonce'] != book['nonce'] + 1):
+        ws.makeLocalBook(market)
+        ws.bookBuffer[market].append(message)
         return
-      ws.localBook[market]['bids'] = sortAndInsert(ws.localBook[market]['bids'], message['bids'], bidsCompare)
-      ws.localBook[market]['asks'] = sortAndInsert(ws.localBook[market]['asks'], message['asks'], asksCompare)
-      ws.localBook[market]['nonce'] = message['nonce']
+      book.apply(message)
 
   ws.callbacks['subscriptionBookUser'][market](ws.localBook[market])
 
+class rpcError(Exception):
+  def __init__(self, response):
+    self.response = response
+    self.errorCode = response.get('errorCode')
+    Exception.__init__(self, response.get('error'))
+
 class rateLimitThread (threading.Thread):
   def __init__(self, reset, bitvavo):
     self.timeToWait = reset
@@ -123,10 +237,15 @@ class receiveThread (threading.Thread):
       while(self.wsObject.keepAlive):
         self.ws.run_forever()
         self.wsObject.reconnect = True
+        self.wsObject.open = False
         self.wsObject.authenticated = False
+        # Back off only while the connection keeps failing; a healthy session resets the timer.
+        if self.wsObject.openedAt is not None and time.time() - self.wsObject.openedAt >= HEALTHY_CONNECTION:
+          self.wsObject.reconnectTimer = RECONNECT_TIMER
+        self.wsObject.openedAt = None
         time.sleep(self.wsObject.reconnectTimer)
         debugToConsole("we have just set reconnect to true and have waited for " + str(self.wsObject.reconnectTimer))
-        self.wsObject.reconnectTimer = self.wsObject.reconnectTimer * 2
+        self.wsObject.reconnectTimer = min(self.wsObject.reconnectTimer * 2, MAX_RECONNECT_TIMER)
     except KeyboardInterrupt:
       debugToConsole("We caught keyboard interrupt in the websocket thread.")
 
@@ -141,6 +260,7 @@ class Bitvavo:
     self.rateLimitRemaining = 1000
     self.rateLimitReset = 0
     self.timeout = None
+    self.session = requests.Session()
     global debugging
     debugging = False
     for key in options:
@@ -197,9 +317,9 @@ class Bitvavo:
         'bitvavo-access-timestamp': str(now),
         'bitvavo-access-window': str(self.ACCESSWINDOW)
       }
-      r = requests.get(url, headers = headers, timeout = self.timeout)
+      r = self.session.get(url, headers = headers, timeout = self.timeout)
     else:
-      r = requests.get(url, timeout = self.timeout)
+      r = self.session.get(url, timeout = self.timeout)
     if('error' in r.json()):
       self.updateRateLimit(r.json())
     else:
@@ -217,7 +337,7 @@ class Bitvavo:
       'bitvavo-access-window': str(self.ACCESSWINDOW),
     }
     debugToConsole("REQUEST: " + url)
-    r = requests.request(method, url, headers=headers, json=body, timeout=self.timeout)
+    r = self.session.request(method, url, headers=headers, json=body, timeout=self.timeout)
     if 'error' in r.json():
       self.updateRateLimit(r.json())
     else:
@@ -374,14 +494,43 @@ class Bitvavo:
       self.APISECRET = APISECRET
       self.ACCESSWINDOW = ACCESSWINDOW
       self.wsUrl = WSURL
-      self.open = False
+      self.initState(bitvavo)
+
+      self.subscribe()
+
+    # State that does not depend on an open connection (also used by benchDispatch).
+    def initState(self, bitvavo):
+      self.openEvent = threading.Event()
+      self.authEvent = threading.Event()
+      self.sendQueue = deque()
+      self.sendLock = threading.Lock()
+      self.pending = {}
+      self.pendingLock = threading.Lock()
+      self.requestIds = itertools.count(1)
       self.callbacks = {}
       self.keepAlive = True
       self.reconnect = False
-      self.reconnectTimer = 0.1
+      self.reconnectTimer = RECONNECT_TIMER
+      self.openedAt = None
+      self.lastCandle = {}
+      self.candleFetcher = None
+      self.candleHold = {}
+      self.candleHoldLock = threading.Lock()
+      self.keepBookCopy = False
       self.bitvavo = bitvavo
-
-      self.subscribe()
+      self.eventHandlers = self.makeEventHandlers()
+
+    def makeEventHandlers(self):
+      return {
+        'authenticate': self.onAuthenticate,
+        'fill': self.onAccount,
+        'order': self.onAccount,
+        'ticker': self.onTicker,
+        'ticker24h': self.onTicker24h,
+        'candle': self.onCandle,
+        'book': self.onBook,
+        'trade': self.onTrade
+      }
 
     def subscribe(self):
       websocket.enableTrace(False)
@@ -399,32 +548,97 @@ class Bitvavo:
       self.authenticated = False
       self.keepBookCopy = False
       self.localBook = {}
+      self.bookBuffer = {}
+      self.bookResyncs = {}
 
     def closeSocket(self):
       self.ws.close()
       self.keepAlive = False
       self.receiveThread.join()
 
-    def waitForSocket(self, ws, message, private):
-      if (not private and self.open) or (private and self.authenticated and self.open):
-        return
+    @property
+    def open(self):
+      return self.openEvent.is_set()
+
+    @open.setter
+    def open(self, value):
+      if value:
+        self.openEvent.set()
+      else:
+        self.openEvent.clear()
+
+    @property
+    def authenticated(self):
+      return self.authEvent.is_set()
+
+    @authenticated.setter
+    def authenticated(self, value):
+      if value:
+        self.authEvent.set()
       else:
-        time.sleep(0.1)
-        self.waitForSocket(ws, message, private)
+        self.authEvent.clear()
+
+    def isReady(self, private = False):
+      return self.open and (not private or self.authenticated)
+
+    # Block until the socket is usable (and authenticated for private calls). Returns False on timeout.
+    def waitForSocket(self, private = False, timeout = None):
+      deadline = None if timeout is None else time.time() + timeout
+      if not self.openEvent.wait(timeout):
+        return False
+      if private:
+        remaining = None if deadline is None else max(deadline - time.time(), 0)
+        return self.authEvent.wait(remaining)
+      return True
+
+    def waitUntilOpen(self, timeout = None):
+      return self.waitForSocket(False, timeout)
 
+    def waitUntilAuthenticated(self, timeout = None):
+      return self.waitForSocket(True, timeout)
+
+    # Send right away when the socket is ready, otherwise queue until it is (see flushQueue).
     def doSend(self, ws, message, private = False):
       if private and self.APIKEY == '':
         errorToConsole('You did not set the API key, but requested a private function.')
         return
-      self.waitForSocket(ws, message, private)
-      ws.send(message)
-      debugToConsole('SENT: ' + message)
+      with self.sendLock:
+        if self.isReady(private):
+          try:
+            ws.send(message)
+            if debugging:
+              debugToConsole('SENT: ' + message)
+            return
+          except Exception as e:
+            debugToConsole('Send failed, queueing message: ' + str(e))
+        self.sendQueue.append((message, private))
+
+    def flushQueue(self):
+      with self.sendLock:
+        pending = self.sendQueue
+        self.sendQueue = deque()
+        for message, private in pending:
+          if self.isReady(private):
+            try:
+              self.ws.send(message)
+              if debugging:
+                debugToConsole('SENT: ' + message)
+              continue
+            except Exception as e:
+              debugToConsole('Send failed, keeping message queued: ' + str(e))
+          self.sendQueue.append((message, private))
 
     def on_message(self, ws, msg):
-      debugToConsole('RECEIVED: ' + msg)
-      msg = json.loads(msg)
+      if debugging:
+        debugToConsole('RECEIVED: ' + msg)
+      self.dispatch(loads(msg))
+
+    def dispatch(self, msg):
       callbacks = self.callbacks
 
+      if 'requestId' in msg and self.resolveRequest(msg):
+        return
+
       if 'error' in msg:
         if msg['errorCode'] == 105:
           self.bitvavo.updateRateLimit(msg)
@@ -433,93 +647,128 @@ class Bitvavo:
         else:
           errorToConsole(json.dumps(msg, indent=2))
 
-      if 'action' in msg:
-        if(msg['action'] == 'getTime'):
-          callbacks['time'](msg['response'])
-        elif(msg['action'] == 'getMarkets'):
-          callbacks['markets'](msg['response'])
-        elif(msg['action'] == 'getAssets'):
-          callbacks['assets'](msg['response'])
-        elif(msg['action'] == 'getTrades'):
-          callbacks['publicTrades'](msg['response'])
-        elif(msg['action'] == 'getCandles'):
-          callbacks['candles'](msg['response'])
-        elif(msg['action'] == 'getTicker24h'):
-          callbacks['ticker24h'](msg['response'])
-        elif(msg['action'] == 'getTickerPrice'):
-          callbacks['tickerPrice'](msg['response'])
-        elif(msg['action'] == 'getTickerBook'):
-          callbacks['tickerBook'](msg['response'])
-        elif(msg['action'] == 'privateCreateOrder'):
-          callbacks['placeOrder'](msg['response'])
-        elif(msg['action'] == 'privateUpdateOrder'):
-          callbacks['updateOrder'](msg['response'])
-        elif(msg['action'] == 'privateGetOrder'):
-          callbacks['getOrder'](msg['response'])
-        elif(msg['action'] == 'privateCancelOrder'):
-          callbacks['cancelOrder'](msg['response'])
-        elif(msg['action'] == 'privateGetOrders'):
-          callbacks['getOrders'](msg['response'])
-        elif(msg['action'] == 'privateGetOrdersOpen'):
-          callbacks['ordersOpen'](msg['response'])
-        elif(msg['action'] == 'privateGetTrades'):
-          callbacks['trades'](msg['response'])
-        elif(msg['action'] == 'privateGetAccount'):
-          callbacks['account'](msg['response'])
-        elif(msg['action'] == 'privateGetFees'):
-          callbacks['fees'](msg['response'])
-        elif(msg['action'] == 'privateGetBalance'):
-          callbacks['balance'](msg['response'])
-        elif(msg['action'] == 'privateDepositAssets'):
-          callbacks['depositAssets'](msg['response'])
-        elif(msg['action'] == 'privateWithdrawAssets'):
-          callbacks['withdrawAssets'](msg['response'])
-        elif(msg['action'] == 'privateGetDepositHistory'):
-          callbacks['depositHistory'](msg['response'])
-        elif(msg['action'] == 'privateGetWithdrawalHistory'):
-          callbacks['withdrawalHistory'](msg['response'])
-        elif(msg['action'] == 'privateCancelOrders'):
-          callbacks['cancelOrders'](msg['response'])
-        elif(msg['action'] == 'getBook'):
-          market = msg['response']['market']
-          if('book' in callbacks):
-            callbacks['book'](msg['response'])
-          if(self.keepBookCopy):
-            if(market in callbacks['subscriptionBook']):
-              callbacks['subscriptionBook'][market](ws, msg)
-
-      elif('event' in msg):
-        if(msg['event'] == 'authenticate'):
-          self.authenticated = True
-          debugToConsole('Authenticated Websocket.')
-        elif(msg['event'] == 'fill'):
-          market = msg['market']
-          callbacks['subscriptionAccount'][market](msg)
-        elif(msg['event'] == 'order'):
-          market = msg['market']
-          callbacks['subscriptionAccount'][market](msg)
-        elif(msg['event'] == 'ticker'):
-          market = msg['market']
-          callbacks['subscriptionTicker'][market](msg)
-        elif(msg['event'] == 'ticker24h'):
-          for entry in msg['data']:
-            callbacks['subscriptionTicker24h'][entry['market']](entry)
-        elif(msg['event'] == 'candle'):
-          market = msg['market']
-          interval = msg['interval']
-          callbacks['subscriptionCandles'][market][interval](msg)
-        elif(msg['event'] == 'book'):
-          market = msg['market']
-          if('subscriptionBookUpdate' in callbacks):
-            if(market in callbacks['subscriptionBookUpdate']):
-              callbacks['subscriptionBookUpdate'][market](msg)
-          if(self.keepBookCopy):
-            if(market in callbacks['subscriptionBook']):
-              callbacks['subscriptionBook'][market](ws, msg)
-        elif(msg['event'] == 'trade'):
-          market = msg['market']
-          if('subscriptionTrades' in callbacks):
-            callbacks['subscriptionTrades'][market](msg)
+      action = msg.get('action')
+      if action is not None:
+        if 'response' not in msg:
+          return
+        name = ACTION_CALLBACKS.get(action)
+        if name is not None:
+          if name in callbacks:
+            callbacks[name](msg['response'])
+        elif action == 'getBook':
+          self.onGetBook(msg)
+        return
+
+      handler = self.eventHandlers.get(msg.get('event'))
+      if handler is not None:
+        handler(msg)
+
+    # Send one request tagged with its own requestId and return a Future for its response.
+    # Many requests can be in flight at once; each is resolved independently.
+    def request(self, action, options = None, private = False):
+      future = Future()
+      if private and self.APIKEY == '':
+        future.set_exception(rpcError({ 'error': 'No API key set for private action ' + action }))
+        return future
+      message = dict(_default(options, {}))
+      message['action'] = action
+      message['requestId'] = next(self.requestIds)
+      with self.pendingLock:
+        self.pending[message['requestId']] = future
+      self.doSend(self.ws, json.dumps(message), private)
+      return future
+
+    # Blocking helper around request(). Forgets the request if it times out.
+    def call(self, action, options = None, private = False, timeout = None):
+      future = self.request(action, options, private)
+      try:
+        return future.result(timeout)
+      except FutureTimeout:
+        self.forgetRequest(future)
+        raise
+
+    def forgetRequest(self, future):
+      with self.pendingLock:
+        for requestId, pending in list(self.pending.items()):
+          if pending is future:
+            del self.pending[requestId]
+
+    def resolveRequest(self, msg):
+      with self.pendingLock:
+        future = self.pending.pop(msg['requestId'], None)
+      if future is None:
+        return False
+      if 'error' in msg:
+        if msg.get('errorCode') == 105:
+          self.bitvavo.updateRateLimit(msg)
+        future.set_exception(rpcError(msg))
+      else:
+        future.set_result(msg.get('response'))
+      return True
+
+    def onGetBook(self, msg):
+      market = msg['response']['market']
+      if('book' in self.callbacks):
+        self.callbacks['book'](msg['response'])
+      if(self.keepBookCopy):
+        if(market in self.callbacks['subscriptionBook']):
+          self.callbacks['subscriptionBook'][market](self, msg)
+
+    def onAuthenticate(self, msg):
+      self.authenticated = True
+      debugToConsole('Authenticated Websocket.')
+      self.flushQueue()
+
+    def onAccount(self, msg):
+      callback = self.callbacks.get('subscriptionAccount', {}).get(msg['market'])
+      if callback is not None:
+        callback(msg)
+
+    def onTicker(self, msg):
+      callback = self.callbacks.get('subscriptionTicker', {}).get(msg['market'])
+      if callback is not None:
+        callback(msg)
+
+    def onTicker24h(self, msg):
+      subscribed = self.callbacks.get('subscriptionTicker24h', {})
+      for entry in msg['data']:
+        callback = subscribed.get(entry['market'])
+        if callback is not None:
+          callback(entry)
+
+    # Live candles for a key being backfilled are held back until the backfill is merged,
+    # otherwise the newer live candle lands first and the older backfilled ones are dropped.
+    def onCandle(self, msg):
+      key = (msg['market'], msg['interval'])
+      with self.candleHoldLock:
+        held = self.candleHold.get(key)
+        if held is not None:
+          held.append(msg)
+          return
+      self.deliverCandle(msg)
+
+    def deliverCandle(self, msg):
+      key = (msg['market'], msg['interval'])
+      for candle in msg.get('candle', []):
+        if candle[0] > self.lastCandle.get(key, 0):
+          self.lastCandle[key] = candle[0]
+      callback = self.callbacks.get('subscriptionCandles', {}).get(msg['market'], {}).get(msg['interval'])
+      if callback is not None:
+        callback(msg)
+
+    def onBook(self, msg):
+      market = msg['market']
+      callback = self.callbacks.get('subscriptionBookUpdate', {}).get(market)
+      if callback is not None:
+        callback(msg)
+      if(self.keepBookCopy):
+        if(market in self.callbacks['subscriptionBook']):
+          self.callbacks['subscriptionBook'][market](self, msg)
+
+    def onTrade(self, msg):
+      callback = self.callbacks.get('subscriptionTrades', {}).get(msg['market'])
+      if callback is not None:
+        callback(msg)
 
     def on_error(self, ws, error):
       if 'error' in self.callbacks:
@@ -527,40 +776,95 @@ class Bitvavo:
       else:
         errorToConsole(error)
 
-    def on_close(self, ws):
-      self.receiveThread.exit()
+    def on_close(self, ws, *args):
+      self.open = False
+      self.authenticated = False
       debugToConsole('Closed Websocket.')
 
+    # Resubscribe everything in as few messages as possible, then rebuild books and fill candle gaps.
     def checkReconnect(self):
-      if('subscriptionTicker' in self.callbacks):
-        for market in self.callbacks['subscriptionTicker']:
-          self.subscriptionTicker(market, self.callbacks['subscriptionTicker'][market])
-      if('subscriptionTicker24h' in self.callbacks):
-        for market in self.callbacks['subscriptionTicker24h']:
-          self.subscriptionTicker(market, self.callbacks['subscriptionTicker24h'][market])
-      if('subscriptionAccount' in self.callbacks):
-        for market in self.callbacks['subscriptionAccount']:
-          self.subscriptionAccount(market, self.callbacks['subscriptionAccount'][market])
-      if('subscriptionCandles' in self.callbacks):
-        for market in self.callbacks['subscriptionCandles']:
-          for interval in self.callbacks['subscriptionCandles'][market]:
-            self.subscriptionCandles(market, interval, self.callbacks['subscriptionCandles'][market][interval])
-      if('subscriptionTrades' in self.callbacks):
-        for market in self.callbacks['subscriptionTrades']:
-          self.subscriptionTrades(market, self.callbacks['subscriptionTrades'][market])
-      if('subscriptionBookUpdate' in self.callbacks):
-        for market in self.callbacks['subscriptionBookUpdate']:
-          self.subscriptionBookUpdate(market, self.callbacks['subscriptionBookUpdate'][market])
-      if('subscriptionBookUser' in self.callbacks):
-        for market in self.callbacks['subscriptionBookUser']:
-          self.subscriptionBook(market, self.callbacks['subscriptionBookUser'][market])
+      callbacks = self.callbacks
+      if self.candleFetcher is not None:
+        with self.candleHoldLock:
+          for key in self.backfillKeys():
+            self.candleHold.setdefault(key, [])
+      channels = []
+      for name, key in (('ticker', 'subscriptionTicker'), ('ticker24h', 'subscriptionTicker24h'), ('trades', 'subscriptionTrades')):
+        markets = list(callbacks.get(key, {}))
+        if len(markets) > 0:
+          channels.append({ 'name': name, 'markets': markets })
+
+      byInterval = {}
+      for market, intervals in list(callbacks.get('subscriptionCandles', {}).items()):
+        for interval in intervals:
+          byInterval.setdefault(interval, []).append(market)
+      for interval, markets in byInterval.items():
+        channels.append({ 'name': 'candles', 'interval': [interval], 'markets': markets })
+
+      bookMarkets = list(dict.fromkeys(list(callbacks.get('subscriptionBookUpdate', {})) + list(callbacks.get('subscriptionBookUser', {}))))
+      if len(bookMarkets) > 0:
+        channels.append({ 'name': 'book', 'markets': bookMarkets })
+
+      if len(channels) > 0:
+        self.doSend(self.ws, json.dumps({ 'action': 'subscribe', 'channels': channels }))
+      accountMarkets = list(callbacks.get('subscriptionAccount', {}))
+      if len(accountMarkets) > 0:
+        self.doSend(self.ws, json.dumps({ 'action': 'subscribe', 'channels': [{ 'name': 'account', 'markets': accountMarkets }] }), True)
+
+      for market in list(callbacks.get('subscriptionBookUser', {})):
+        self.requestBookSnapshot(market)
+      self.backfillCandles()
+
+    # fetcher(market, interval, start) returns candles newest first, like the REST endpoint.
+    # The application supplies it so backfill goes through its own rate limiting.
+    def setCandleBackfill(self, fetcher):
+      self.candleFetcher = fetcher
+
+    def backfillKeys(self):
+      subscribed = self.callbacks.get('subscriptionCandles', {})
+      return [key for key in list(self.lastCandle) if key[1] in subscribed.get(key[0], {})]
+
+    # Replay candles missed while disconnected through the normal candle callback, oldest first,
+    # then release the live candles held for that key in arrival order.
+    def backfillCandles(self):
+      fetcher = self.candleFetcher
+      if fetcher is None:
+        return
+      for key in self.backfillKeys():
+        market, interval = key
+        try:
+          missed = fetcher(market, interval, self.lastCandle[key])
+        except Exception as e:
+          errorToConsole('Candle backfill failed for ' + market + ': ' + str(e))
+          missed = None
+        if isinstance(missed, list):
+          for candle in reversed(missed):
+            self.deliverCandle({ 'event': 'candle', 'market': market, 'interval': interval, 'candle': [candle] })
+        self.releaseCandles(key)
+      # Keys unsubscribed meanwhile must not stay held forever.
+      with self.candleHoldLock:
+        stale = list(self.candleHold)
+      for key in stale:
+        self.releaseCandles(key)
+
+    def releaseCandles(self, key):
+      while True:
+        with self.candleHoldLock:
+          held = self.candleHold.get(key)
+          if not held:
+            self.candleHold.pop(key, None)
+            return
+          self.candleHold[key] = []
+        for msg in held:
+          self.deliverCandle(msg)
 
     def on_open(self, ws):
       now = int(time.time()*1000)
       self.open = True
-      self.reconnectTimer = 0.5
+      self.openedAt = time.time()
       if self.APIKEY != '':
         self.doSend(self.ws, json.dumps({ 'window':str(self.ACCESSWINDOW), 'action': 'authenticate', 'key': self.APIKEY, 'signature': createSignature(now, 'GET', '/websocket', {}, self.APISECRET), 'timestamp': now }))
+      self.flushQueue()
       if self.reconnect:
         debugToConsole("we started reconnecting " + str(self.checkReconnect))
         thread = threading.Thread(target = self.checkReconnect)
@@ -734,6 +1038,11 @@ class Bitvavo:
       self.callbacks['subscriptionTicker'][market] = callback
       self.doSend(self.ws, json.dumps({ 'action': 'subscribe', 'channels': [{ 'name': 'ticker', 'markets': [market] }] }))
 
+    def unsubscribeTicker(self, market):
+      if market in self.callbacks.get('subscriptionTicker', {}):
+        del self.callbacks['subscriptionTicker'][market]
+      self.doSend(self.ws, json.dumps({ 'action': 'unsubscribe', 'channels': [{ 'name': 'ticker', 'markets': [market] }] }))
+
     def subscriptionTicker24h(self, market, callback):
       if 'subscriptionTicker24h' not in self.callbacks:
         self.callbacks['subscriptionTicker24h'] = {}
@@ -754,6 +1063,13 @@ class Bitvavo:
       self.callbacks['subscriptionCandles'][market][interval] = callback
       self.doSend(self.ws, json.dumps({ 'action': 'subscribe', 'channels': [{ 'name': 'candles', 'interval': [interval], 'markets': [market] }] }))
 
+    def unsubscribeCandles(self, market, interval):
+      if interval in self.callbacks.get('subscriptionCandles', {}).get(market, {}):
+        del self.callbacks['subscriptionCandles'][market][interval]
+        if len(self.callbacks['subscriptionCandles'][market]) == 0:
+          del self.callbacks['subscriptionCandles'][market]
+      self.doSend(self.ws, json.dumps({ 'action': 'unsubscribe', 'channels': [{ 'name': 'candles', 'interval': [interval], 'markets': [market] }] }))
+
     def subscriptionTrades(self, market, callback):
       if 'subscriptionTrades' not in self.callbacks:
         self.callbacks['subscriptionTrades'] = {}
@@ -776,5 +1092,18 @@ class Bitvavo:
       self.callbacks['subscriptionBook'][market] = processLocalBook
       self.doSend(self.ws, json.dumps({ 'action': 'subscribe', 'channels': [{ 'name': 'book', 'markets': [market] }] }))
 
-      self.localBook[market] = {}
+      self.localBook[market] = localOrderBook(market)
+      self.requestBookSnapshot(market)
+
+    # Buffer book events for this market until a fresh snapshot arrives.
+    def requestBookSnapshot(self, market):
+      self.bookBuffer[market] = deque(maxlen=BOOK_BUFFER_SIZE)
       self.doSend(self.ws, json.dumps({ 'action': 'getBook', 'market': market }))
+
+    def makeLocalBook(self, market):
+      self.bookResyncs[market] = self.bookResyncs.get(market, 0) + 1
+      debugToConsole('Resyncing local book for ' + market + ' (' + str(self.bookResyncs[market]) + ' times).')
+      self.requestBookSnapshot(market)
+
+    def getBookResyncs(self):
+      return dict(self.bookResyncs)
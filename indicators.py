@@ -0,0 +1,206 @@
+from collections import deque
+import numpy as np
+
+OPEN, HIGH, LOW, CLOSE, VOLUME = range(5)
+
+# 🧱 تحويل قوائم الشموع إلى مصفوفة (symbols × candles × OHLCV) مع حشو NaN
+# الترتيب كما يعيده Bitvavo: الأحدث أولاً
+def candles_to_array(candle_lists, length=60):
+    arr = np.full((len(candle_lists), length, 5), np.nan)
+    lengths = np.zeros(len(candle_lists), dtype=int)
+    for i, candles in enumerate(candle_lists):
+        rows = [c[1:6] for c in candles[:length]]
+        if rows:
+            arr[i, :len(rows)] = np.asarray(rows, dtype=float)
+        lengths[i] = len(rows)
+    return arr, lengths
+
+# 📐 متوسط القيم ضمن قناع لكل صف (0 إن كان القناع فارغاً)
+def _masked_mean(values, mask):
+    count = mask.sum(axis=1)
+    total = np.where(mask, values, 0.0).sum(axis=1)
+    return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+
+# 🧠 نفس مؤشرات analyze_trend لكل العملات دفعة واحدة
+def batch_trend(arr, lengths):
+    n, length, _ = arr.shape
+    rows = np.arange(n)
+    idx = np.arange(length)[None, :]
+    last_i = np.maximum(lengths - 1, 0)
+
+    highs, lows = arr[:, :, HIGH], arr[:, :, LOW]
+    closes, volumes = arr[:, :, CLOSE], arr[:, :, VOLUME]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        high = np.fmax.reduce(highs, axis=1)
+        low = np.fmin.reduce(lows, axis=1)
+        first = closes[:, 0]
+        last = closes[rows, last_i]
+
+        position = np.round((last - low) / (high - low) * 100, 1)
+        slope = np.round((last - first) / first * 100, 2)
+        volatility = np.round((high - low) / low * 100, 2)
+        wave = np.round((np.fmax.reduce(closes, axis=1) - np.fmin.reduce(closes, axis=1)) / low * 100, 2)
+
+        # volumes[-1] > متوسط volumes[:-5] × 2
+        last_volume = volumes[rows, last_i]
+        volume_spike = last_volume > _masked_mean(volumes, idx < (lengths - 5)[:, None]) * 2
+
+        # متوسط آخر 3 شموع مقابل الثلاثين التي قبلها
+        recent = _masked_mean(volumes, (idx >= (lengths - 3)[:, None]) & (idx < lengths[:, None]))
+        past_mask = (idx >= (lengths - 33)[:, None]) & (idx < (lengths - 3)[:, None]) & (lengths >= 36)[:, None]
+        past = _masked_mean(volumes, past_mask)
+        spike_3_30 = (past > 0) & (recent > past * 2)
+
+    valid = (lengths > 5) & np.isfinite(position) & np.isfinite(slope) & np.isfinite(volatility) & np.isfinite(wave)
+
+    return {
+        "position": position,
+        "slope": slope,
+        "volatility": volatility,
+        "wave": wave,
+        "volume_spike": volume_spike,
+        "spike_3_30": spike_3_30,
+        "valid": valid
+    }
+
+# 🏁 تقييم كل العملات من نتائج batch_trend وإرجاع جدول مرتب حسب النقاط
+def rank_table(symbols, lengths, trend, params):
+    pos_ok = trend["position"] < params["pos_max"]
+    slope_ok = trend["slope"] > params["slope_min"]
+    wave_ok = trend["wave"] > params["wave_min"]
+    vol_ok = trend["volatility"] > params["vol_min"]
+    base = pos_ok.astype(int) + slope_ok + wave_ok + vol_ok
+
+    # نقاط الدخول (Spike 3m>30m بنقطتين) ونقاط العرض (volume_spike بنقطة)
+    score = base + 2 * trend["spike_3_30"]
+    display_score = base + trend["volume_spike"]
+
+    table = []
+    for i in np.flatnonzero(trend["valid"]):
+        table.append({
+            "symbol": symbols[i],
+            "length": int(lengths[i]),
+            "trend": {
+                "position": float(trend["position"][i]),
+                "slope": float(trend["slope"][i]),
+                "volatility": float(trend["volatility"][i]),
+                "wave": float(trend["wave"][i]),
+                "volume_spike": bool(trend["volume_spike"][i])
+            },
+            "checks": {
+                "pos": bool(pos_ok[i]),
+                "slope": bool(slope_ok[i]),
+                "wave": bool(wave_ok[i]),
+                "vol": bool(vol_ok[i]),
+                "spike_3_30": bool(trend["spike_3_30"][i])
+            },
+            "score": int(score[i]),
+            "display_score": int(display_score[i])
+        })
+
+    table.sort(key=lambda x: x["score"], reverse=True)
+    return table
+
+# ⚡ حالة اتجاه تراكمية لكل عملة: تحديث O(1) مع كل شمعة جديدة
+# النوافذ الدوارة للقمم والقيعان بطوابير رتيبة، والأحجام بمجاميع جارية
+class TrendState:
+    def __init__(self, window=60):
+        self.window = window
+        self.closed = deque()  # الشموع المغلقة (الأقدم أولاً)
+        self.current = None    # الشمعة المفتوحة، قد تُستبدل عدة مرات
+        self._seq = 0
+        self._max_high = deque()
+        self._min_low = deque()
+        self._max_close = deque()
+        self._min_close = deque()
+        self._volume_sum = 0.0
+
+    @classmethod
+    def from_candles(cls, candles, window=60):
+        state = cls(window)
+        for c in reversed(candles[:window]):
+            state.update(c)
+        return state
+
+    def __len__(self):
+        return len(self.closed) + (self.current is not None)
+
+    # ➕ شمعة بنفس توقيت المفتوحة تستبدلها، والأحدث تغلقها
+    def update(self, candle):
+        c = (int(candle[0]),) + tuple(float(x) for x in candle[1:6])
+        if self.current is not None:
+            if c[0] == self.current[0]:
+                self.current = c
+                return
+            if c[0] < self.current[0]:
+                return
+            self._close(self.current)
+        self.current = c
+
+    def _close(self, c):
+        seq = self._seq
+        self._seq += 1
+        self.closed.append(c)
+        self._volume_sum += c[5]
+        _push_max(self._max_high, seq, c[2])
+        _push_min(self._min_low, seq, c[3])
+        _push_max(self._max_close, seq, c[4])
+        _push_min(self._min_close, seq, c[4])
+
+        if len(self.closed) > self.window - 1:
+            old = self.closed.popleft()
+            self._volume_sum -= old[5]
+            expire = self._seq - (self.window - 1)
+            for dq in (self._max_high, self._min_low, self._max_close, self._min_close):
+                while dq and dq[0][0] < expire:
+                    dq.popleft()
+
+    # شمعة حسب ترتيبها الزمني داخل النافذة
+    def _at(self, i):
+        return self.closed[i] if i < len(self.closed) else self.current
+
+    def _volume_at(self, start, stop):
+        return sum(self._at(i)[5] for i in range(start, stop))
+
+    # 📊 مؤشرات النافذة بنفس دلالات قائمة Bitvavo (الأحدث أولاً)
+    def snapshot(self):
+        n = len(self)
+        cur = self.current
+        high = max(self._max_high[0][1], cur[2]) if self._max_high else cur[2]
+        low = min(self._min_low[0][1], cur[3]) if self._min_low else cur[3]
+        max_close = max(self._max_close[0][1], cur[4]) if self._max_close else cur[4]
+        min_close = min(self._min_close[0][1], cur[4]) if self._min_close else cur[4]
+        newest = cur[4]
+        oldest = self._at(0)
+
+        # volumes[-1] هو الأقدم، و volumes[:-5] هي الأحدث n-5
+        total = self._volume_sum + cur[5]
+        newer = n - 5
+        volume_spike = newer > 0 and oldest[5] > (total - self._volume_at(0, min(5, n))) / newer * 2
+
+        # متوسط volumes[-3:] مقابل volumes[-33:-3]
+        spike_3_30 = False
+        if n >= 36:
+            recent = self._volume_at(0, 3) / 3
+            past = self._volume_at(3, 33) / 30
+            spike_3_30 = past > 0 and recent > past * 2
+
+        return {
+            "position": round((oldest[4] - low) / (high - low) * 100, 1),
+            "slope": round((oldest[4] - newest) / newest * 100, 2),
+            "volatility": round((high - low) / low * 100, 2),
+            "wave": round((max_close - min_close) / low * 100, 2),
+            "volume_spike": volume_spike,
+            "spike_3_30": spike_3_30
+        }
+
+def _push_max(dq, seq, value):
+    while dq and dq[-1][1] <= value:
+        dq.pop()
+    dq.append((seq, value))
+
+def _push_min(dq, seq, value):
+    while dq and dq[-1][1] >= value:
+        dq.pop()
+    dq.append((seq, value))
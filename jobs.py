@@ -0,0 +1,102 @@
+import time
+import threading
+from memory import redis_calls, reset_redis_calls
+
+# ⏱️ مُجدول مهام بوتيرات مستقلة: لكل مهمة خيطها وموعدها ومهلتها
+# مسح بطيء لا يؤخر فحص الخروج لأن كل مهمة تدور في خيط منفصل
+class Job:
+    def __init__(self, name, func, interval, deadline=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.deadline = deadline or interval
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_run = 0
+        self.last_redis = 0
+        self.total_redis = 0
+
+    def run_forever(self):
+        next_run = time.time()
+        while True:
+            started = time.time()
+            reset_redis_calls()
+            try:
+                self.func()
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ خطأ في مهمة {self.name}:", e)
+
+            duration = time.time() - started
+            self.runs += 1
+            self.last_run = started
+            self.last_duration = duration
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.last_redis = redis_calls()
+            self.total_redis += self.last_redis
+            if duration > self.deadline:
+                self.overruns += 1
+                print(f"🐢 مهمة {self.name} تجاوزت مهلتها: {duration:.2f}s > {self.deadline:.2f}s")
+
+            # المواعيد الفائتة لا تُعوض دفعة واحدة، بل نقفز إلى الموعد التالي
+            next_run += self.interval
+            now = time.time()
+            if next_run < now:
+                missed = int((now - next_run) // self.interval) + 1
+                self.skipped += missed
+                next_run += missed * self.interval
+            time.sleep(max(0, next_run - time.time()))
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "deadline": self.deadline,
+            "runs": self.runs,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "last": round(self.last_duration, 3),
+            "max": round(self.max_duration, 3),
+            "avg": round(self.total_duration / self.runs, 3) if self.runs else 0.0,
+            "redis": self.last_redis,
+            "redis_avg": round(self.total_redis / self.runs, 1) if self.runs else 0.0
+        }
+
+jobs = {}
+_started = set()
+_lock = threading.Lock()
+
+# ➕ تسجيل مهمة: interval بين بدايات التشغيل، deadline المدة المسموحة لكل تشغيل
+def register(name, func, interval, deadline=None):
+    jobs[name] = Job(name, func, interval, deadline)
+    return jobs[name]
+
+# 🚀 تشغيل كل مهمة مسجلة في خيط خاص (مرة واحدة لكل مهمة)
+def start():
+    with _lock:
+        for name, job in jobs.items():
+            if name in _started:
+                continue
+            _started.add(name)
+            threading.Thread(target=job.run_forever, name=f"job-{name}", daemon=True).start()
+
+def job_stats():
+    return [job.stats() for job in jobs.values()]
+
+# 📊 تقرير نصي لمقاييس المهام
+def jobs_report():
+    lines = []
+    for s in job_stats():
+        lines.append(
+            f"{s['name']}: كل {s['interval']}s | تشغيل={s['runs']} | متوسط={s['avg']}s | "
+            f"أقصى={s['max']}s | تجاوز={s['overruns']} | فائت={s['skipped']} | أخطاء={s['errors']} | "
+            f"Redis={s['redis']} (متوسط {s['redis_avg']})"
+        )
+    return "\n".join(lines) or "لا توجد مهام مسجلة."
@@ -0,0 +1,99 @@
+import os
+import time
+import threading
+from bitvavo_client.bitvavo import Bitvavo
+from utils import push_candle, fetch_missed_candles
+from ratelimit import limiter
+
+PRICE_MAX_AGE = float(os.getenv("PRICE_MAX_AGE", 5))  # ثوانٍ قبل اعتبار السعر قديماً
+RPC_TIMEOUT = float(os.getenv("WS_RPC_TIMEOUT", 3))
+
+_ws = None
+_lock = threading.Lock()
+_tickers = set()
+_candles = set()  # (market, interval)
+_on_price = None
+last_prices = {}  # market -> (price, timestamp)
+
+# 🔌 فتح اتصال WebSocket واحد مشترك لكل البث الحي
+def start_feed(on_price=None):
+    global _ws, _on_price
+    _on_price = on_price
+    if _ws is None:
+        _ws = Bitvavo({}).newWebsocket()
+        _ws.setErrorCallback(_handle_error)
+        _ws.setCandleBackfill(fetch_missed_candles)
+    return _ws
+
+# ⛔ خطأ 105 عبر WebSocket يوقف كل الطلبات عبر نفس ميزانية الوزن
+def _handle_error(msg):
+    if isinstance(msg, dict) and msg.get("errorCode") == 105:
+        limiter.ban(msg)
+    print("WS error:", msg)
+
+# 📈 تحديث جدول الأسعار مع كل تيكر
+def _handle_ticker(msg):
+    price = msg.get("lastPrice")
+    if price is None:
+        return
+    market = msg["market"]
+    price = float(price)
+    last_prices[market] = (price, time.time())
+    if _on_price:
+        try:
+            _on_price(market, price)
+        except Exception as e:
+            print("Price feed error:", e)
+
+# 🔁 مزامنة اشتراكات التيكر مع الصفقات النشطة
+def sync_tickers(markets):
+    if _ws is None:
+        return
+    markets = set(markets)
+    with _lock:
+        added = markets - _tickers
+        removed = _tickers - markets
+        _tickers.difference_update(removed)
+        _tickers.update(added)
+    for market in added:
+        _ws.subscriptionTicker(market, _handle_ticker)
+    for market in removed:
+        _ws.unsubscribeTicker(market)
+        last_prices.pop(market, None)
+
+# 💶 آخر سعر حي إن كان حديثاً، وإلا None
+def get_price(market, max_age=PRICE_MAX_AGE):
+    entry = last_prices.get(market)
+    if entry and time.time() - entry[1] <= max_age:
+        return entry[0]
+    return None
+
+# 🕯️ دمج الشموع الحية في مخزن الشموع
+def _handle_candle(msg):
+    for candle in msg.get("candle", []):
+        push_candle(msg["market"], msg["interval"], candle)
+
+# 🔁 مزامنة اشتراكات الشموع مع كون المسح
+def sync_candles(markets, interval="1m"):
+    if _ws is None:
+        return
+    wanted = {(m, interval) for m in markets}
+    with _lock:
+        current = {k for k in _candles if k[1] == interval}
+        added = wanted - current
+        removed = current - wanted
+        _candles.difference_update(removed)
+        _candles.update(added)
+    for market, iv in added:
+        _ws.subscriptionCandles(market, iv, _handle_candle)
+    for market, iv in removed:
+        _ws.unsubscribeCandles(market, iv)
+
+# 📨 طلب عبر نفس الاتصال المفتوح بدل رحلة HTTP (None إن لم يكن الاتصال جاهزاً)
+def rpc_ready():
+    return _ws is not None and _ws.open
+
+def rpc(action, options=None, timeout=RPC_TIMEOUT):
+    if not rpc_ready():
+        return None
+    return _ws.call(action, options, timeout=timeout)
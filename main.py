@@ -1,38 +1,61 @@
 import os
 import time
-import redis
 import json
 from uuid import uuid4
 import threading
-import requests
-from utils import bitvavo_request
-from market_scanner import pick_best_symbol
-from memory import save_trade, get_top_confident
+from concurrent.futures import ThreadPoolExecutor
+from utils import TELEGRAM_URL, HTTP_TIMEOUT, http_request, bitvavo_request, MarketSnapshot, \
+    fetch_price, get_all_prices, value_in_eur
+from market_scanner import pick_best_symbol, refresh_universe
+from jobs import register, start, jobs_report
+from memory import r, save_trade, get_top_confident, freeze, clear_freezes, cached_hash, STRATEGY_KEY
+from live_feed import start_feed, sync_tickers, get_price
+from notifier import notify
+from ratelimit import request_priority, PRIORITY_POSITION, PRIORITY_REPORT
 from dotenv import load_dotenv
 
 load_dotenv()
-r = redis.from_url(os.getenv("REDIS_URL"))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = str(os.getenv("CHAT_ID"))
 BUY_AMOUNT_EUR = float(os.getenv("BUY_AMOUNT_EUR", 20))
+POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", 50))
 
 ACTIVE_TRADES_KEY = "nems:active_trades"
 TRADE_KEY = "nems:trades"
 TRAIL_KEY = "nems:trailing"
+PRICE_FEED = os.getenv("PRICE_FEED", "1") == "1"
+COMMAND_WORKERS = int(os.getenv("COMMAND_WORKERS", 3))
+EXIT_INTERVAL = float(os.getenv("EXIT_INTERVAL", 1))
+SCAN_INTERVAL = float(os.getenv("SCAN_INTERVAL", 10))
+UNIVERSE_INTERVAL = float(os.getenv("UNIVERSE_INTERVAL", 300))
+BALANCE_TTL = 15  # ثوانٍ يُعاد فيها نفس تقرير الرصيد دون طلبات جديدة
+
+live_trades = {}  # نسخة في الذاكرة من الصفقات النشطة لفحص الخروج مع كل تيكر
+_selling = set()
+_sell_failures = {}  # العملة ← (عدد المحاولات الفاشلة، وقت السماح بالمحاولة التالية)
+SELL_RETRY_DELAY = 2
+SELL_RETRY_MAX = 60
+_exit_lock = threading.Lock()
+
+# 🧵 الأوامر تُنفذ في مجمع خيوط حتى لا يتوقف الاستقبال بانتظار أمر بطيء
+command_pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS)
+_balance_cache = {"time": 0, "text": None}
 
 def send_message(text):
-    print(">>", text)
-    try:
-        requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", data={
-            "chat_id": CHAT_ID,
-            "text": text
-        })
-    except:
-        pass
+    notify(text)
 
 def get_balance():
+    now = time.time()
+    if _balance_cache["text"] and now - _balance_cache["time"] < BALANCE_TTL:
+        return _balance_cache["text"]
+    _balance_cache["text"] = _build_balance()
+    _balance_cache["time"] = time.time()
+    return _balance_cache["text"]
+
+def _build_balance():
     balances = bitvavo_request("GET", "/balance")
+    prices = get_all_prices()
     total_value = 0.0
     summary = []
 
@@ -45,12 +68,13 @@ def get_balance():
             if symbol == "EUR":
                 total_value += available
                 summary.append(f"EUR: {available:.2f}€")
-            else:
-                ticker = bitvavo_request("GET", f"/ticker/price?market={symbol}-EUR")
-                price = float(ticker.get("price", 0))
-                value = price * available
-                total_value += value
-                summary.append(f"{symbol}: {available:.2f} ≈ {value:.2f}€")
+                continue
+            value = value_in_eur(symbol, available, prices)
+            if value is None:
+                summary.append(f"{symbol}: {available:.2f} ≈ ؟ (لا يوجد سعر)")
+                continue
+            total_value += value
+            summary.append(f"{symbol}: {available:.2f} ≈ {value:.2f}€")
         except:
             continue
 
@@ -74,20 +98,22 @@ def buy(symbol):
             fills = res.get("fills", [])
             if not fills or "price" not in fills[0] or float(fills[0]["price"]) == 0:
                 send_message(f"❌ فشل الشراء أو السعر صفر لـ {symbol} - سيتم تجميدها مؤقتًا")
-                r.set(f"nems:freeze:{symbol}", "1", ex=1800)  # تجميد 30 دقيقة
+                freeze(symbol, 1800)  # تجميد 30 دقيقة
                 return None, None
 
             price = float(fills[0]["price"])
             amount = float(fills[0]["amount"])
 
-            r.hset(ACTIVE_TRADES_KEY, symbol, json.dumps({
+            trade = {
                 "symbol": symbol,
                 "entry": price,
                 "amount": amount,
                 "trail": price,
                 "trail_percent": 0.5,
                 "max_profit": 0
-            }))
+            }
+            r.hset(ACTIVE_TRADES_KEY, symbol, json.dumps(trade))
+            live_trades[symbol] = trade
             send_message(f"✅ شراء {symbol} بسعر {price:.12f}")
             return price, amount
 
@@ -98,7 +124,7 @@ def buy(symbol):
     else:
         reason = res.get("error") or json.dumps(res, ensure_ascii=False)
         send_message(f"❌ فشل شراء {symbol}: {reason}")
-        r.set(f"nems:freeze:{symbol}", "1", ex=600)
+        freeze(symbol, 600)
         return None, None
 
 def sell(symbol, amount, entry):
@@ -121,6 +147,7 @@ def sell(symbol, amount, entry):
             save_trade(symbol, entry, price, "auto-sell", result, profit)
             send_message(f"💰 بيع {symbol} بسعر {price:.4f} | الربح: {profit:.2f}%")
             r.hdel(ACTIVE_TRADES_KEY, symbol)
+            live_trades.pop(symbol, None)
             return True
         except Exception as e:
             send_message(f"⚠️ البيع تم لكن فشل تحليل البيانات: {e}")
@@ -129,87 +156,164 @@ def sell(symbol, amount, entry):
         send_message(f"❌ فشل بيع {symbol}: {res}")
         return False
 
+# 🛡️ بيع واحد فقط لكل عملة حتى لو اجتمع التيكر والحلقة على نفس الإشارة
+# البيع الفاشل يُعاد بتأخير متضاعف حتى لا يرسل كل تيكر أمراً جديداً
+def request_sell(symbol, amount, entry):
+    with _exit_lock:
+        if symbol in _selling or _sell_blocked(symbol):
+            return
+        _selling.add(symbol)
+    try:
+        if r.hexists(ACTIVE_TRADES_KEY, symbol):
+            ok = sell(symbol, amount, entry)
+            with _exit_lock:
+                if ok:
+                    _sell_failures.pop(symbol, None)
+                else:
+                    failures = _sell_failures.get(symbol, (0, 0))[0] + 1
+                    delay = min(SELL_RETRY_DELAY * 2 ** (failures - 1), SELL_RETRY_MAX)
+                    _sell_failures[symbol] = (failures, time.time() + delay)
+    finally:
+        with _exit_lock:
+            _selling.discard(symbol)
+
+def _sell_blocked(symbol):
+    failure = _sell_failures.get(symbol)
+    return failure is not None and time.time() < failure[1]
+
+# ⚖️ تطبيق شروط الخروج على سعر جديد
+# store: pipeline لحفظ الذروة، أو None لتحديثها في الذاكرة فقط (مسار التيكر)
+def evaluate_trade(trade, price, store=None):
+    symbol = trade["symbol"]
+    entry = trade["entry"]
+    trail_percent = trade.get("trail_percent", 0.5)
+    max_profit = trade.get("max_profit", 0)
+    profit = (price - entry) / entry * 100
+
+    # ✅ تحديث الذروة
+    if profit > max_profit:
+        trade["max_profit"] = round(profit, 4)
+        if store is not None:
+            store.hset(ACTIVE_TRADES_KEY, symbol, json.dumps(trade))
+        return None
+
+    # ✅ شرط التريلينغ
+    if max_profit >= 2 and profit <= max_profit - trail_percent:
+        return "trail"
+    # ✅ شرط ستوب لوس
+    if profit <= -2:
+        return "stop"
+    return None
+
+# ⚡ فحص الخروج لحظة وصول التيكر (من خيط WebSocket)
+# لا طلبات Redis هنا: الذروة تبقى في live_trades وتحفظها مهمة exits كل ثانية
+def on_price_tick(symbol, price):
+    trade = live_trades.get(symbol)
+    if not trade or symbol in _selling or _sell_blocked(symbol):
+        return
+    if evaluate_trade(trade, price):
+        threading.Thread(target=request_sell, args=(symbol, trade["amount"], trade["entry"]), daemon=True).start()
+
 def monitor_trades():
     active = r.hgetall(ACTIVE_TRADES_KEY)
+    # تحديثات الذروة (من التيكر ومن هذه الدورة) تُجمع في pipeline واحد وتُكتب قبل أي بيع
+    pipe = r.pipeline(transaction=False)
+    current = {}
     for symbol_b, trade_json in active.items():
         try:
             trade = json.loads(trade_json)
             symbol = trade["symbol"]
-            entry = trade["entry"]
-            amount = trade["amount"]
-            trail_percent = trade.get("trail_percent", 0.5)
-            max_profit = trade.get("max_profit", 0)
-
-            ticker = bitvavo_request("GET", f"/ticker/price?market={symbol}")
-            price = float(ticker.get("price", 0))
-            profit = (price - entry) / entry * 100
-
-            # ✅ تحديث الذروة
-            if profit > max_profit:
-                trade["max_profit"] = round(profit, 4)
-                r.hset(ACTIVE_TRADES_KEY, symbol, json.dumps(trade))
+            known = live_trades.get(symbol)
+            if known and known.get("max_profit", 0) > trade.get("max_profit", 0):
+                trade["max_profit"] = known["max_profit"]
+                pipe.hset(ACTIVE_TRADES_KEY, symbol, json.dumps(trade))
+            current[symbol] = trade
+        except Exception as e:
+            print("Monitor error:", e)
+    for symbol in list(live_trades):
+        if symbol not in current:
+            live_trades.pop(symbol, None)
+            _sell_failures.pop(symbol, None)
+    live_trades.update(current)
+    sync_tickers(current)
+
+    exits = []
+    for symbol, trade in current.items():
+        try:
+            price = get_price(symbol)
+            if price is None:
+                price = fetch_price(symbol, priority=PRIORITY_POSITION)
+            if price is None:
                 continue
 
-            # ✅ شرط التريلينغ
-            if max_profit >= 2 and profit <= max_profit - trail_percent:
-                sell(symbol, amount, entry)
-            # ✅ شرط ستوب لوس
-            elif profit <= -2:
-                sell(symbol, amount, entry)
+            if evaluate_trade(trade, price, store=pipe):
+                exits.append(trade)
 
         except Exception as e:
             print("Monitor error:", e)
 
-def trader_loop():
-    while True:
-        active = r.hgetall(ACTIVE_TRADES_KEY)
-        if len(active) < 2:
-            symbol, reason, trend = pick_best_symbol()
-            if symbol and symbol.encode() not in active:
-                send_message(f"🚨 إشارة شراء: {reason}")
-                buy(symbol)
-            else:
-                print("🔍 لا فرص أو العملة مكررة...")
-        else:
-            # ✅ مقارنة القوة بين العملات النشطة والجديدة
-            symbol, reason, trend = pick_best_symbol()
-            if not symbol:
-                monitor_trades()
-                time.sleep(2)
-                continue
+    if len(pipe):
+        pipe.execute()
+    for trade in exits:
+        request_sell(trade["symbol"], trade["amount"], trade["entry"])
 
-            new_score = sum([
-                trend["position"] < 25,
-                trend["slope"] > -1,
-                trend["wave"] > 4,
-                trend["volatility"] > 1.5
-            ])
-
-            worst_symbol = None
-            worst_score = 99
-            for sym_b, trade_json in active.items():
-                sym = sym_b.decode()
-                from utils import get_candles, analyze_trend
-                candles = get_candles(sym, interval="1m", limit=60)
-                trend_old = analyze_trend(candles)
-                old_score = sum([
-                    trend_old["position"] < 25,
-                    trend_old["slope"] > -1,
-                    trend_old["wave"] > 4,
-                    trend_old["volatility"] > 1.5
-                ])
-                if old_score < worst_score:
-                    worst_symbol = sym
-                    worst_score = old_score
-
-            if worst_symbol and new_score >= worst_score + 2:
-                send_message(f"🔁 استبدال {worst_symbol} بفرصة أقوى: {symbol}")
-                old_trade = json.loads(active[worst_symbol.encode()])
-                sell(worst_symbol, old_trade["amount"], old_trade["entry"])
-                buy(symbol)
-
-        monitor_trades()
-        time.sleep(2)
+# 🎯 دورة الدخول: شراء عند وجود مكان، أو استبدال أضعف صفقة بفرصة أقوى
+# لقطة واحدة للدورة: المسح والاستبدال يقرآن نفس الشموع والمؤشرات
+def entry_cycle():
+    active = r.hgetall(ACTIVE_TRADES_KEY)
+    snapshot = MarketSnapshot()
+    if len(active) < 2:
+        symbol, reason, trend = pick_best_symbol(snapshot)
+        if symbol and symbol.encode() not in active:
+            send_message(f"🚨 إشارة شراء: {reason}")
+            buy(symbol)
+        else:
+            print("🔍 لا فرص أو العملة مكررة...")
+        return
+
+    # ✅ مقارنة القوة بين العملات النشطة والجديدة
+    symbol, reason, trend = pick_best_symbol(snapshot)
+    if not symbol:
+        return
+
+    new_score = sum([
+        trend["position"] < 25,
+        trend["slope"] > -1,
+        trend["wave"] > 4,
+        trend["volatility"] > 1.5
+    ])
+
+    worst_symbol = None
+    worst_score = 99
+    for sym_b, trade_json in active.items():
+        sym = sym_b.decode()
+        trend_old = snapshot.metrics(sym, interval="1m", limit=60)
+        if trend_old is None:
+            continue
+        old_score = sum([
+            trend_old["position"] < 25,
+            trend_old["slope"] > -1,
+            trend_old["wave"] > 4,
+            trend_old["volatility"] > 1.5
+        ])
+        if old_score < worst_score:
+            worst_symbol = sym
+            worst_score = old_score
+
+    if worst_symbol and new_score >= worst_score + 2:
+        send_message(f"🔁 استبدال {worst_symbol} بفرصة أقوى: {symbol}")
+        old_trade = json.loads(active[worst_symbol.encode()])
+        # عبر request_sell حتى لا يتزامن مع بيع من مهمة الخروج
+        request_sell(worst_symbol, old_trade["amount"], old_trade["entry"])
+        buy(symbol)
+
+# ⏱️ كل مهمة بوتيرتها: الخروج سريع، الدخول أبطأ، وتحديث القائمة في الخلفية
+def trader_loop():
+    register("exits", monitor_trades, EXIT_INTERVAL)
+    register("entries", entry_cycle, SCAN_INTERVAL, deadline=SCAN_INTERVAL * 5)
+    # max_age يمنع تحديثاً ثانياً إن سبقته دورة الدخول (كما عند بدء التشغيل)
+    register("universe", lambda: refresh_universe(UNIVERSE_INTERVAL / 2), UNIVERSE_INTERVAL, deadline=60)
+    start()
 
 def get_summary():
     trades = [json.loads(x) for x in r.lrange(TRADE_KEY, 0, -1)]
@@ -228,14 +332,16 @@ def get_summary():
 
     # 🔁 تحليل تغييرات الاستراتيجية
     adjustments = []
-    if r.exists("nems:strategy:position"):
-        pos = float(r.get("nems:strategy:position"))
+    # القيم في hash واحد يكتبه memory.adjust_strategy_from_trade
+    strategy = cached_hash(STRATEGY_KEY)
+    if b"position" in strategy:
+        pos = float(strategy[b"position"])
         adjustments.append(f"📉 تم تخفيض شرط Position إلى {pos:.1f}% بعد تجارب ناجحة.")
-    if r.exists("nems:strategy:slope"):
-        slope = float(r.get("nems:strategy:slope"))
+    if b"slope" in strategy:
+        slope = float(strategy[b"slope"])
         adjustments.append(f"📈 تم رفع شرط Slope إلى {slope:.2f}% لتقليل الصفقات الخاسرة.")
-    if r.exists("nems:strategy:wave"):
-        wave = float(r.get("nems:strategy:wave"))
+    if b"wave" in strategy:
+        wave = float(strategy[b"wave"])
         adjustments.append(f"🌊 تم تعديل شرط Wave إلى {wave:.1f}% بناءً على الأداء.")
 
     strategy_notes = "\n".join(adjustments) or "⚙️ لا توجد تعديلات استراتيجية حالياً."
@@ -262,6 +368,13 @@ def get_summary():
 """
 
 def handle_telegram_command(text):
+    try:
+        with request_priority(PRIORITY_REPORT):
+            _handle_command(text)
+    except Exception as e:
+        print("Telegram command error:", e)
+
+def _handle_command(text):
     text = text.strip().lower()
     if "رصيد" in text:
         send_message(f"💰 الرصيد:\n{get_balance()}")
@@ -269,8 +382,7 @@ def handle_telegram_command(text):
         send_message(get_summary())
     elif text == "reset":
         r.delete(ACTIVE_TRADES_KEY)
-        for k in r.scan_iter("nems:freeze:*"):
-            r.delete(k)
+        clear_freezes()
         send_message("♻️ تم إعادة ضبط جميع الصفقات.")
     elif "شو عم تعمل" in text:
         active = r.hgetall(ACTIVE_TRADES_KEY)
@@ -285,39 +397,60 @@ def handle_telegram_command(text):
         symbol = text.split(" ", 1)[-1].strip().upper()
         r.hdel("nems:active_trades", symbol)
         send_message(f"🧹 تم حذف الصفقة المفتوحة لـ {symbol}")
+    elif "المهام" in text:
+        send_message(f"⏱️ أداء المهام:\n{jobs_report()}")
     elif "شو شايف" in text or "أقوى عملات" in text:
-        from market_scanner import get_top_candidates
-        top = get_top_candidates()
-        msg = "👁️ العملات الأقوى حاليًا:\n"
+        from market_scanner import get_top_candidates, SNAPSHOT_MAX_AGE
+        top, age = get_top_candidates()
+        if age is None:
+            send_message("⏳ لم يكتمل أول مسح بعد، حاول بعد قليل.")
+            return
+        if not top:
+            send_message("❌ لا يوجد بيانات حالياً.")
+            return
+        msg = f"👁️ العملات الأقوى (آخر مسح قبل {int(age)} ثانية):\n"
+        if age > SNAPSHOT_MAX_AGE:
+            msg = "⚠️ الترتيب قديم، قد يكون المسح متأخراً.\n" + msg
         for i, (symbol, score, debug) in enumerate(top, 1):
             msg += f"{i}. {symbol} | نقاط={score} | {' | '.join(debug)}\n"
-        send_message(msg.strip() or "❌ لا يوجد بيانات حالياً.")
+        send_message(msg.strip())
+
+# 📥 استقبال الأوامر عبر long polling: الطلب يبقى معلقاً حتى تصل رسالة
 def telegram_polling():
     offset = None
+    delay = 1
+    url = f"{TELEGRAM_URL}/bot{BOT_TOKEN}/getUpdates"
     while True:
         try:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates"
-            if offset:
-                url += f"?offset={offset}"
+            params = {"timeout": POLL_TIMEOUT, "allowed_updates": '["message"]'}
+            if offset is not None:
+                params["offset"] = offset
 
-            response = requests.get(url)
+            response = http_request("GET", url, params=params, timeout=(HTTP_TIMEOUT[0], POLL_TIMEOUT + 10))
             res = response.json()
+            if not res.get("ok"):
+                raise ValueError(res.get("description", res))
 
             for update in res.get("result", []):
-                offset = update["update_id"] + 1
+                # نتقدم بالـ offset قبل التنفيذ حتى لا يُعاد أمر فشل تنفيذه
+                offset = max(offset or 0, update["update_id"] + 1)
                 message = update.get("message", {})
                 text = message.get("text")
                 chat = message.get("chat", {})
                 chat_id = str(chat.get("id"))
 
                 if chat_id == CHAT_ID and text:
-                    handle_telegram_command(text)
+                    command_pool.submit(handle_telegram_command, text)
+            delay = 1
 
         except Exception as e:
             print("Telegram polling error:", e)
-        time.sleep(2)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
 
 if __name__ == "__main__":
     send_message("🚀 النمس الذكي بدأ العمل - يدير صفقتين ويستخدم Trailing Stop.")
-    threading.Thread(target=trader_loop).start()
+    if PRICE_FEED:
+        start_feed(on_price_tick)
+    trader_loop()
     telegram_polling()
\ No newline at end of file
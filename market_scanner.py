@@ -1,16 +1,22 @@
-import requests
 import os
 import time
-import redis
 import json
-from utils import get_candles
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import public_request, get_candles, prune_candle_store, MarketSnapshot
+from live_feed import sync_candles
+from ratelimit import limiter
+from memory import r, frozen_symbols, cached_hash, invalidate
 
-r = redis.from_url(os.getenv("REDIS_URL"))
 CONFIDENCE_KEY = "nems:confidence"
-FREEZE_PREFIX = "nems:freeze:"
 PARAMS_KEY = "nems:strategy_params"
+LIVE_CANDLES = os.getenv("LIVE_CANDLES", "1") == "1"
+UNIVERSE_MAX_AGE = 600  # حد أقصى لعمر قائمة العملات إن لم تُحدّث في الخلفية
+SNAPSHOT_MAX_AGE = 120  # بعدها يُعلَّم آخر ترتيب في تيليغرام بأنه قديم
 last_fetch = 0
 cached_top = []
+last_ranking = None  # آخر جدول تقييم حسبه المتداول: {"time", "table"}
+_universe_lock = threading.Lock()
 
 # ⚙️ تحميل أو إنشاء المعايير الديناميكية
 def load_params():
@@ -21,233 +27,217 @@ def load_params():
         "vol_min": 1.5,
         "min_score": 3
     }
-    saved = r.hgetall(PARAMS_KEY)
-    for k, v in default.items():
-        if k not in saved:
-            r.hset(PARAMS_KEY, k, v)
+    saved = cached_hash(PARAMS_KEY)
+    missing = [k for k in default if k.encode() not in saved]
+    if missing:
+        pipe = r.pipeline(transaction=False)
+        for k in missing:
+            pipe.hsetnx(PARAMS_KEY, k, default[k])
+        pipe.execute()
+        invalidate(PARAMS_KEY)
     return {k: float(saved.get(k.encode(), v)) for k, v in default.items()}
 
-# 🧠 تحليل المؤشرات للشموع
-def analyze_trend(candles):
-    closes = [float(c[4]) for c in candles]
-    highs = [float(c[2]) for c in candles]
-    lows = [float(c[3]) for c in candles]
-    volumes = [float(c[5]) for c in candles]
-
-    high = max(highs)
-    low = min(lows)
-    last = closes[-1]
-
-    return {
-        "position": round((last - low) / (high - low) * 100, 1),
-        "slope": round((closes[-1] - closes[0]) / closes[0] * 100, 2),
-        "volatility": round((high - low) / low * 100, 2),
-        "wave": round((max(closes) - min(closes)) / low * 100, 2),
-        "volume_spike": volumes[-1] > (sum(volumes[:-5]) / len(volumes[:-5])) * 2
-    }
+# ⚙️ إعدادات المسح المتوازي
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", 8))
+PRESCREEN_VOLUME = int(os.getenv("PRESCREEN_VOLUME", 30))
+PRESCREEN_MOVERS = int(os.getenv("PRESCREEN_MOVERS", 20))
+
+# الخيوط تُبطَّأ تلقائياً عبر ميزانية الوزن المشتركة في ratelimit
+def _scan_candles(symbol, interval, limit):
+    candles = get_candles(symbol, interval=interval, limit=limit)
+    if not isinstance(candles, list):
+        raise ValueError(candles.get("error", candles) if isinstance(candles, dict) else candles)
+    return candles
+
+# 🔎 تحليل عملة واحدة من الكون
+def _scan_market(symbol):
+    stats = {"symbol": symbol, "change_7d": None, "explosive": False}
+
+    # 🔸 آخر 30 دقيقة
+    candles_30m = _scan_candles(symbol, "1m", 30)
+    stats["volume_30m"] = sum(float(c[5]) for c in candles_30m)
+
+    # 🔸 آخر 7 أيام (1d)
+    candles_7d = _scan_candles(symbol, "1d", 7)
+    if len(candles_7d) >= 2:
+        start = float(candles_7d[0][4])
+        end = float(candles_7d[-1][4])
+        stats["change_7d"] = ((end - start) / start) * 100
+
+    # 🔸 هل حصل انفجار بيومي؟ (أكثر من 10%)
+    for c in candles_7d:
+        open_ = float(c[1])
+        close = float(c[4])
+        if (close - open_) / open_ * 100 >= 10:
+            stats["explosive"] = True
+            break
+
+    return stats
+
+# 📡 فرز أولي لكل السوق من طلب ticker/24h واحد
+def prescreen_markets():
+    tickers = []
+    for t in public_request("/ticker/24h", weight=25):
+        try:
+            if not t["market"].endswith("-EUR"):
+                continue
+            open_ = float(t.get("open") or 0)
+            last = float(t.get("last") or 0)
+            volume_quote = float(t.get("volumeQuote") or 0)
+            if open_ <= 0 or last <= 0 or volume_quote <= 0:
+                continue
+            tickers.append({
+                "symbol": t["market"],
+                "volume_24h": volume_quote,
+                "change_24h": (last - open_) / open_ * 100
+            })
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    by_volume = sorted(tickers, key=lambda x: x["volume_24h"], reverse=True)
+    by_change = sorted(tickers, key=lambda x: x["change_24h"], reverse=True)
+    shortlist = list(dict.fromkeys(
+        [x["symbol"] for x in by_volume[:PRESCREEN_VOLUME] + by_change[:PRESCREEN_MOVERS]]
+    ))
+    return by_volume, shortlist
 
 # 🔀 دمج عملات من مصادر مختلفة
 def collect_mixed_top_markets():
     print("🔍 بدء تجميع العملات من مصادر متنوعة...")
     try:
-        res = requests.get("https://api.bitvavo.com/v2/markets")
-        all_markets = [m["market"] for m in res.json() if "-EUR" in m["market"]]
-
-        top_30min = []
-        top_24h = []
-        top_7d = []
-        explosive = []
-
-        for symbol in all_markets:
-            try:
-                base = symbol.replace("-EUR", "")
-
-                # 🔸 آخر 30 دقيقة
-                candles_30m = get_candles(symbol, interval="1m", limit=30)
-                volume_30m = sum(float(c[5]) for c in candles_30m)
-                top_30min.append((symbol, volume_30m))
-
-                # 🔸 آخر 24 ساعة (15m * 96)
-                candles_1d = get_candles(symbol, interval="15m", limit=96)
-                volume_1d = sum(float(c[5]) for c in candles_1d)
-                top_24h.append((symbol, volume_1d))
-
-                # 🔸 آخر 7 أيام (1d)
-                candles_7d = get_candles(symbol, interval="1d", limit=7)
-                if len(candles_7d) >= 2:
-                    start = float(candles_7d[0][4])
-                    end = float(candles_7d[-1][4])
-                    change = ((end - start) / start) * 100
-                    top_7d.append((symbol, change))
-
-                # 🔸 هل حصل انفجار بيومي؟ (أكثر من 10%)
-                for c in candles_7d:
-                    open_ = float(c[1])
-                    close = float(c[4])
-                    if (close - open_) / open_ * 100 >= 10:
-                        explosive.append(symbol)
-                        break
-
-            except Exception as e:
-                continue
-
-        top_30min = sorted(top_30min, key=lambda x: x[1], reverse=True)[:10]
-        top_24h = sorted(top_24h, key=lambda x: x[1], reverse=True)[:10]
-        top_7d = sorted(top_7d, key=lambda x: x[1], reverse=True)[:10]
+        started = time.time()
+        by_volume, shortlist = prescreen_markets()
+        print(f"📡 الفرز الأولي: {len(by_volume)} عملة ← {len(shortlist)} للتحليل بالشموع")
+
+        results = []
+        failures = {}
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            futures = {pool.submit(_scan_market, symbol): symbol for symbol in shortlist}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    failures[symbol] = str(e)
+
+        if failures:
+            sample = " | ".join(f"{s}: {e}" for s, e in list(failures.items())[:5])
+            print(f"⚠️ فشل تحليل {len(failures)} عملة: {sample}")
+
+        # ترتيب ثابت بغض النظر عن ترتيب انتهاء الخيوط
+        order = {symbol: i for i, symbol in enumerate(shortlist)}
+        results.sort(key=lambda x: order[x["symbol"]])
+
+        top_30min = sorted(results, key=lambda x: x["volume_30m"], reverse=True)[:10]
+        top_24h = by_volume[:10]
+        top_7d = sorted([x for x in results if x["change_7d"] is not None],
+                        key=lambda x: x["change_7d"], reverse=True)[:10]
+        explosive = [x["symbol"] for x in results if x["explosive"]]
 
         combined = list(dict.fromkeys(
-            [x[0] for x in top_30min + top_24h + top_7d] + explosive
+            [x["symbol"] for x in top_30min + top_24h + top_7d] + explosive
         ))
 
-        print(f"✅ تم تجميع {len(combined)} عملة.")
+        headroom = limiter.headroom()
+        print(f"✅ تم تجميع {len(combined)} عملة خلال {time.time() - started:.1f} ثانية "
+              f"(رصيد الطلبات {headroom['remaining']}/{headroom['limit']}).")
         return combined[:40]
 
     except Exception as e:
         print(f"❌ خطأ في جمع العملات: {e}")
         return []
 
-# 🧠 اختيار العملة بناءً على نظام النقاط الذكي
-def pick_best_symbol():
-    global last_fetch, cached_top
-    now = time.time()
+def _mark(ok):
+    return "✅" if ok else "❌"
+
+# 📦 حالات الاتجاه للكون غير المجمّد لتقييمها دفعة واحدة
+def _load_universe(min_len, snapshot):
+    frozen = frozen_symbols()
+    return [
+        symbol for symbol in cached_top
+        if symbol not in frozen and snapshot.length(symbol, interval="1m", limit=60) >= min_len
+    ]
 
-    if now - last_fetch > 300:
+# 🔄 تحديث قائمة العملات إن كانت أقدم من max_age
+def refresh_universe(max_age=0):
+    global last_fetch, cached_top
+    with _universe_lock:
+        now = time.time()
+        if last_fetch and now - last_fetch < max_age:
+            return cached_top
         cached_top = collect_mixed_top_markets()
         last_fetch = now
+        prune_candle_store(cached_top)
+        return cached_top
 
-    frozen = set(k.decode().split(FREEZE_PREFIX)[-1] for k in r.scan_iter(f"{FREEZE_PREFIX}*"))
-    params = load_params()
-    candidates = []
-
-    for symbol in cached_top:
-        if symbol in frozen:
-            continue
-
-        try:
-            candles = get_candles(symbol, interval="1m", limit=60)
-            if len(candles) < 40:
-                continue
+# 🧠 اختيار العملة بناءً على نظام النقاط الذكي
+# snapshot: لقطة الدورة الحالية حتى يعيد المستبدل استخدام نفس الشموع والمؤشرات
+def pick_best_symbol(snapshot=None):
+    global last_ranking
+    snapshot = snapshot or MarketSnapshot()
+    refresh_universe(UNIVERSE_MAX_AGE)
 
-            trend = analyze_trend(candles)
-            confidence = float(r.hget(CONFIDENCE_KEY, symbol) or 1.0)
-
-            score = 0
-            debug = []
-            notes = []
-
-            if trend["position"] < params["pos_max"]:
-                score += 1
-                debug.append(f"✅ Pos={trend['position']}%")
-            else:
-                debug.append(f"❌ Pos={trend['position']}%")
-
-            if trend["slope"] > params["slope_min"]:
-                score += 1
-                debug.append(f"✅ Slope={trend['slope']}%")
-            else:
-                debug.append(f"❌ Slope={trend['slope']}%")
-
-            if trend["wave"] > params["wave_min"]:
-                score += 1
-                debug.append(f"✅ Wave={trend['wave']}%")
-            else:
-                debug.append(f"❌ Wave={trend['wave']}%")
-
-            if trend["volatility"] > params["vol_min"]:
-                score += 1
-                debug.append(f"✅ Vol={trend['volatility']}%")
-            else:
-                debug.append(f"❌ Vol={trend['volatility']}%")
-
-            # Volume Spike
-            volumes = [float(c[5]) for c in candles]
-            recent = sum(volumes[-3:]) / 3
-            past = sum(volumes[-33:-3]) / 30 if len(volumes) >= 36 else 0
-            if past > 0 and recent > past * 2:
-                score += 2
-                debug.append("✅ Volume Spike (3m>30m)")
-                notes.append("🔼 نشاط مفاجئ")
-            else:
-                debug.append("❌ Volume Spike")
+    if LIVE_CANDLES:
+        sync_candles(cached_top)
 
+    params = load_params()
+    symbols = _load_universe(30, snapshot)
+    table = snapshot.score(symbols, params)
+    last_ranking = {"time": time.time(), "table": table}
+    eligible = []
+    for row in table:
+        if row["score"] < 4:
+            break
+        if row["length"] >= 40:
+            eligible.append(row)
+
+    # الثقة من الكاش المحلي، ولا تُقرأ من Redis إلا بعد إبطالها
+    candidates = []
+    if eligible:
+        confidences = cached_hash(CONFIDENCE_KEY)
+        for row in eligible:
+            confidence = float(confidences.get(row["symbol"].encode()) or 1.0)
             if confidence < 0.5:
-                notes.append("⚠️ ثقة منخفضة")
                 continue
-
-            if score >= 4:
-                candidates.append((symbol, score, debug, trend, notes, confidence))
-
-        except Exception as e:
-            print(f"⚠️ خطأ في {symbol}: {e}")
-            continue
+            candidates.append((row, confidence))
 
     if candidates:
-        best = max(candidates, key=lambda x: (x[1], x[5]))
-        reason = f"🔥 {best[0]} | نقاط={best[1]} | " + " | ".join(best[2])
-        if best[4]:
-            reason += " | " + " ".join(best[4])
-        return best[0], reason, best[3]
+        best, _ = max(candidates, key=lambda x: (x[0]["score"], x[1]))
+        trend, checks = best["trend"], best["checks"]
+        debug = [
+            f"{_mark(checks['pos'])} Pos={trend['position']}%",
+            f"{_mark(checks['slope'])} Slope={trend['slope']}%",
+            f"{_mark(checks['wave'])} Wave={trend['wave']}%",
+            f"{_mark(checks['vol'])} Vol={trend['volatility']}%",
+            "✅ Volume Spike (3m>30m)" if checks["spike_3_30"] else "❌ Volume Spike"
+        ]
+        reason = f"🔥 {best['symbol']} | نقاط={best['score']} | " + " | ".join(debug)
+        if checks["spike_3_30"]:
+            reason += " | 🔼 نشاط مفاجئ"
+        return best["symbol"], reason, trend
 
     return None, None, None
 
 # 📋 عرض أقوى العملات حتى لو لم تصل للحد الأدنى للنقاط
+# تُقرأ فقط من آخر ترتيب حسبه المتداول (بلا أي طلب للمنصة)، وتُعاد معها عمره بالثواني
 def get_top_candidates(limit=5):
-    global last_fetch, cached_top
-    now = time.time()
-
-    if now - last_fetch > 600:
-        cached_top = collect_mixed_top_markets()
-        last_fetch = now
+    ranking = last_ranking
+    if ranking is None:
+        return [], None
+    table = ranking["table"]
+    age = time.time() - ranking["time"]
 
-    frozen = set(k.decode().split(FREEZE_PREFIX)[-1] for k in r.scan_iter(f"{FREEZE_PREFIX}*"))
-    params = load_params()
     results = []
-
-    for symbol in cached_top:
-        if symbol in frozen:
-            continue
-        try:
-            candles = get_candles(symbol, interval="1m", limit=60)
-            if len(candles) < 30:
-                continue
-
-            trend = analyze_trend(candles)
-            score = 0
-            debug = []
-
-            if trend["position"] < params["pos_max"]:
-                score += 1
-                debug.append(f"✅ Pos")
-            else:
-                debug.append(f"❌ Pos")
-
-            if trend["slope"] > params["slope_min"]:
-                score += 1
-                debug.append(f"✅ Slope")
-            else:
-                debug.append(f"❌ Slope")
-
-            if trend["wave"] > params["wave_min"]:
-                score += 1
-                debug.append(f"✅ Wave")
-            else:
-                debug.append(f"❌ Wave")
-
-            if trend["volatility"] > params["vol_min"]:
-                score += 1
-                debug.append(f"✅ Vol")
-            else:
-                debug.append(f"❌ Vol")
-
-            if trend["volume_spike"]:
-                score += 1
-                debug.append(f"✅ Spike")
-            else:
-                debug.append(f"❌ Spike")
-
-            results.append((symbol, score, debug))
-        except:
-            continue
+    for row in table:
+        checks = row["checks"]
+        debug = [
+            f"{_mark(checks['pos'])} Pos",
+            f"{_mark(checks['slope'])} Slope",
+            f"{_mark(checks['wave'])} Wave",
+            f"{_mark(checks['vol'])} Vol",
+            f"{_mark(row['trend']['volume_spike'])} Spike"
+        ]
+        results.append((row["symbol"], row["display_score"], debug))
 
     sorted_results = sorted(results, key=lambda x: x[1], reverse=True)
-    return sorted_results[:limit]
\ No newline at end of file
+    return sorted_results[:limit], age
@@ -1,12 +1,111 @@
 import redis
 import os
 import json
+import time
+import threading
+from redis.client import Pipeline
 
-r = redis.from_url(os.getenv("REDIS_URL"))
+# 🔢 عداد رحلات Redis لكل خيط: كل أمر رحلة، وكل pipeline رحلة واحدة
+_calls = threading.local()
+
+def _count():
+    _calls.n = getattr(_calls, "n", 0) + 1
+
+def redis_calls():
+    return getattr(_calls, "n", 0)
+
+def reset_redis_calls():
+    _calls.n = 0
+
+class CountingPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        _count()
+        return super().execute(raise_on_error)
+
+class CountingRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        _count()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+r = CountingRedis.from_url(os.getenv("REDIS_URL"))
 
 TRADE_KEY = "nems:trades"
 CONFIDENCE_KEY = "nems:confidence"
 STRATEGY_KEY = "nems:strategy"
+INVALIDATE_CHANNEL = "nems:invalidate"
+CACHE_TTL = 60  # شبكة أمان إن فاتتنا رسالة إبطال
+FREEZE_KEY = "nems:freezes"  # sorted set: العملة ← وقت انتهاء التجميد
+FREEZE_CACHE_TTL = 5
+
+_freeze_cache = {"time": 0, "symbols": frozenset()}
+_freeze_lock = threading.Lock()
+
+# 🗃️ كاش محلي للـ hashes التي لا تتغير إلا عند حفظ صفقة
+# الكتّاب ينشرون اسم المفتاح على INVALIDATE_CHANNEL فتسقطه كل العمليات فوراً
+_hash_cache = {}     # key ← (وقت القراءة، dict)
+_versions = {}       # key ← عدد مرات الإبطال، لرفض نتيجة قراءة سبقت الإبطال
+_cache_lock = threading.Lock()
+_listener = {"thread": None, "live": False}
+
+def cached_hash(key):
+    _ensure_listener()
+    now = time.time()
+    with _cache_lock:
+        entry = _hash_cache.get(key)
+        if entry and _listener["live"] and now - entry[0] < CACHE_TTL:
+            return entry[1]
+        version = _versions.get(key, 0)
+
+    value = r.hgetall(key)
+    with _cache_lock:
+        if _versions.get(key, 0) == version:
+            _hash_cache[key] = (now, value)
+    return value
+
+def _drop(key):
+    with _cache_lock:
+        _hash_cache.pop(key, None)
+        _versions[key] = _versions.get(key, 0) + 1
+
+# 📣 إبطال محلي ونشر الإبطال لباقي العمليات
+def invalidate(key):
+    _drop(key)
+    try:
+        r.publish(INVALIDATE_CHANNEL, key)
+    except Exception as e:
+        print("Cache invalidate error:", e)
+
+def _ensure_listener():
+    if _listener["thread"] is None:
+        with _cache_lock:
+            if _listener["thread"] is None:
+                _listener["thread"] = threading.Thread(target=_listen, daemon=True)
+                _listener["thread"].start()
+
+# 👂 الاستماع لرسائل الإبطال، والكاش معطل طالما الاشتراك منقطع
+def _listen():
+    delay = 1
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            with _cache_lock:
+                _hash_cache.clear()
+                _listener["live"] = True
+            delay = 1
+            for message in pubsub.listen():
+                if message.get("type") == "message":
+                    _drop(message["data"].decode())
+        except Exception as e:
+            print("Cache listener error:", e)
+        with _cache_lock:
+            _listener["live"] = False
+            _hash_cache.clear()
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
 
 # ✅ تخزين الصفقة في الذاكرة
 def save_trade(symbol, entry_price, exit_price, reason, result, percent):
@@ -37,6 +136,7 @@ def update_confidence(symbol, success):
     else:
         new = max(current - 0.3, 0.5)
     r.hset(CONFIDENCE_KEY, symbol, round(new, 2))
+    invalidate(CONFIDENCE_KEY)
 
 # 🧠 تعديل الاستراتيجية بناءً على آخر 3 صفقات
 def adjust_strategy_from_trade():
@@ -65,6 +165,7 @@ def adjust_strategy_from_trade():
     clamp("slope", -5, 5)
     clamp("wave", 1, 15)
     clamp("volatility", 1, 10)
+    invalidate(STRATEGY_KEY)
 
 # 🔒 تثبيت القيم بين حدين
 def clamp(key, min_val, max_val):
@@ -77,9 +178,40 @@ def clamp(key, min_val, max_val):
     except:
         pass
 
+# 🧊 تجميد عملة لمدة محددة بالثواني
+def freeze(symbol, seconds):
+    until = time.time() + seconds
+    r.zadd(FREEZE_KEY, {symbol: until})
+    with _freeze_lock:
+        _freeze_cache["symbols"] = _freeze_cache["symbols"] | {symbol}
+
+# 🧊 العملات المجمدة حالياً: رحلة واحدة (ZRANGEBYSCORE مع حذف المنتهي) وكاش قصير
+def frozen_symbols():
+    now = time.time()
+    with _freeze_lock:
+        if now - _freeze_cache["time"] < FREEZE_CACHE_TTL:
+            return _freeze_cache["symbols"]
+
+    pipe = r.pipeline(transaction=False)
+    pipe.zremrangebyscore(FREEZE_KEY, "-inf", now)
+    pipe.zrangebyscore(FREEZE_KEY, now, "+inf")
+    _, members = pipe.execute()
+    symbols = frozenset(m.decode() for m in members)
+
+    with _freeze_lock:
+        _freeze_cache["time"] = now
+        _freeze_cache["symbols"] = symbols
+    return symbols
+
+def clear_freezes():
+    r.delete(FREEZE_KEY)
+    with _freeze_lock:
+        _freeze_cache["time"] = 0
+        _freeze_cache["symbols"] = frozenset()
+
 # 🥇 جلب العملات الأعلى ثقة
 def get_top_confident(limit=5):
-    raw = r.hgetall(CONFIDENCE_KEY)
+    raw = cached_hash(CONFIDENCE_KEY)
     parsed = [(k.decode(), float(v)) for k, v in raw.items()]
     top = sorted(parsed, key=lambda x: x[1], reverse=True)
     return top[:limit]
@@ -92,4 +224,5 @@ def cleanup_confidence(threshold=0.5):
             if float(v) <= threshold:
                 r.hdel(CONFIDENCE_KEY, k)
         except:
-            continue
\ No newline at end of file
+            continue
+    invalidate(CONFIDENCE_KEY)
\ No newline at end of file
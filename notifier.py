@@ -0,0 +1,100 @@
+import os
+import time
+import queue
+import threading
+from utils import TELEGRAM_URL, http_request
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+CHAT_ID = str(os.getenv("CHAT_ID"))
+MAX_MESSAGE_LEN = 4096
+COALESCE_WINDOW = float(os.getenv("TELEGRAM_COALESCE", 0.5))    # ثوانٍ لتجميع الرسائل المتلاحقة
+MIN_INTERVAL = float(os.getenv("TELEGRAM_MIN_INTERVAL", 1.0))   # حد تيليغرام: رسالة/ثانية لكل محادثة
+MAX_RETRIES = 5
+
+_outbox = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+# 📤 إضافة رسالة إلى الطابور بدون أي انتظار للشبكة
+def notify(text, chat_id=None):
+    print(">>", text)
+    _outbox.put((chat_id or CHAT_ID, text))
+    _ensure_worker()
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, daemon=True)
+            _worker.start()
+
+# 🧵 عامل خلفي: يجمع الدفعات، يحترم حد المحادثة، ويعيد المحاولة
+def _worker_loop():
+    last_sent = {}
+    while True:
+        chat_id, text = _outbox.get()
+        batch = {chat_id: [text]}
+        deadline = time.time() + COALESCE_WINDOW
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                chat_id, text = _outbox.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.setdefault(chat_id, []).append(text)
+
+        for chat_id, texts in batch.items():
+            for chunk in _pack(texts):
+                wait = last_sent.get(chat_id, 0) + MIN_INTERVAL - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                _deliver(chat_id, chunk)
+                last_sent[chat_id] = time.time()
+
+# 📦 دمج الرسائل في أقل عدد ممكن ضمن حد طول تيليغرام
+def _pack(texts):
+    chunks = []
+    current = ""
+    for text in texts:
+        while len(text) > MAX_MESSAGE_LEN:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(text[:MAX_MESSAGE_LEN])
+            text = text[MAX_MESSAGE_LEN:]
+        if not current:
+            current = text
+        elif len(current) + 2 + len(text) <= MAX_MESSAGE_LEN:
+            current += "\n\n" + text
+        else:
+            chunks.append(current)
+            current = text
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _deliver(chat_id, text):
+    delay = 1
+    for attempt in range(MAX_RETRIES):
+        try:
+            res = http_request("POST", f"{TELEGRAM_URL}/bot{BOT_TOKEN}/sendMessage", data={
+                "chat_id": chat_id,
+                "text": text
+            })
+            if res.status_code == 200:
+                return True
+            if res.status_code == 429:
+                retry_after = res.json().get("parameters", {}).get("retry_after", delay)
+                time.sleep(retry_after)
+                continue
+            if res.status_code < 500:
+                print(f"❌ رفض تيليغرام الرسالة ({res.status_code}): {res.text[:200]}")
+                return False
+        except Exception as e:
+            print("Telegram send error:", e)
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+    print("❌ فشل إرسال رسالة تيليغرام بعد عدة محاولات.")
+    return False
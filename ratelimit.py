@@ -0,0 +1,158 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+RATE_LIMIT = int(os.getenv("BITVAVO_RATE_LIMIT", 1000))  # وزن لكل دقيقة
+RATE_WINDOW = 60
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", 8))
+URGENT_SLOTS = int(os.getenv("URGENT_SLOTS", 1))  # مقاعد لا يأخذها إلا الأوامر وأسعار الصفقات
+
+# 🛣️ مسارات الأولوية: الأصغر يُخدم أولاً
+PRIORITY_ORDER = 0     # وضع/إلغاء الأوامر
+PRIORITY_POSITION = 1  # أسعار الصفقات المفتوحة
+PRIORITY_SCAN = 2      # مسح السوق
+PRIORITY_REPORT = 3    # أوامر تيليغرام والتقارير
+
+# الوزن الذي يجب أن يبقى متاحاً بعد طلب من كل مسار
+RESERVES = {
+    PRIORITY_ORDER: 0,
+    PRIORITY_POSITION: 20,
+    PRIORITY_SCAN: int(os.getenv("SCAN_RESERVE", 100)),
+    PRIORITY_REPORT: int(os.getenv("REPORT_RESERVE", 150))
+}
+
+# 🪣 ميزانية وزن مشتركة لكل العملية، تُصحَّح من رؤوس bitvavo-ratelimit
+class RateLimiter:
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = time.time() + window
+        self.banned_until = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+
+    # ⏳ انتظار حتى يتوفر الوزن مع ترك reserve للطلبات الأهم
+    def acquire(self, weight=1, reserve=0):
+        with self._cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now < self.banned_until:
+                    wait = self.banned_until - now
+                elif self.remaining - weight >= reserve:
+                    self.remaining -= weight
+                    return
+                else:
+                    wait = self.reset_at - now
+                self._cond.wait(timeout=max(wait, 0.01))
+
+    # ↩️ إرجاع وزن حُجز لطلب لم يكتمل (رؤوس الرد التالي تصحح أي فرق)
+    def refund(self, weight=1):
+        with self._cond:
+            self._refill(time.time())
+            self.remaining = min(self.limit, self.remaining + weight)
+            self._cond.notify_all()
+
+    # 📬 تحديث الرصيد من رؤوس الرد
+    def update(self, headers):
+        remaining = headers.get("bitvavo-ratelimit-remaining")
+        reset_at = headers.get("bitvavo-ratelimit-resetat")
+        if remaining is None:
+            return
+        with self._cond:
+            if reset_at is not None:
+                reset_at = int(reset_at) / 1000
+                if reset_at > self.reset_at + 1:
+                    # نافذة جديدة عند البورصة: رصيدها هو المرجع
+                    self.remaining = int(remaining)
+                self.reset_at = reset_at
+            self.remaining = min(self.remaining, int(remaining))
+            self._cond.notify_all()
+
+    # ⛔ خطأ 105: حظر حتى الوقت المذكور في الرسالة
+    def ban(self, response):
+        try:
+            until = int(response["error"].split(" at ")[1].split(".")[0]) / 1000
+        except (KeyError, IndexError, ValueError):
+            until = time.time() + self.window
+        with self._cond:
+            self.remaining = 0
+            self.banned_until = until
+            self.reset_at = max(self.reset_at, until)
+        print(f"⛔ حظر من Bitvavo حتى {time.strftime('%H:%M:%S', time.localtime(until))}")
+
+    def headroom(self):
+        with self._cond:
+            now = time.time()
+            self._refill(now)
+            return {
+                "remaining": self.remaining,
+                "limit": self.limit,
+                "reset_in": round(max(self.reset_at - now, 0), 1),
+                "banned": now < self.banned_until
+            }
+
+# 🎟️ عدد محدود من الطلبات المتزامنة تُمنح حسب الأولوية ثم الأقدم
+# آخر urgent مقاعد محجوزة للأوامر وأسعار الصفقات، كما تحجز RESERVES الوزن
+class RequestScheduler:
+    def __init__(self, slots=MAX_INFLIGHT, urgent=URGENT_SLOTS):
+        self.slots = slots
+        self.urgent = min(urgent, slots - 1)
+        self.busy = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def lane(self, priority):
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while self.busy >= self._limit(priority) or self._waiting[0] != ticket:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.busy += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.busy -= 1
+                self._cond.notify_all()
+
+    def _limit(self, priority):
+        return self.slots if priority <= PRIORITY_POSITION else self.slots - self.urgent
+
+    def queued(self):
+        with self._cond:
+            return len(self._waiting)
+
+limiter = RateLimiter()
+scheduler = RequestScheduler()
+_local = threading.local()
+
+# 🏷️ تحديد أولوية كل الطلبات داخل كتلة (مثل أوامر تيليغرام)
+@contextmanager
+def request_priority(level):
+    previous = getattr(_local, "priority", None)
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def resolve_priority(priority, method="GET"):
+    if priority is not None:
+        return priority
+    current = getattr(_local, "priority", None)
+    if current is not None:
+        return current
+    return PRIORITY_SCAN if method == "GET" else PRIORITY_ORDER
@@ -3,12 +3,53 @@ import json
 import time
 import hmac
 import hashlib
+import threading
+from collections import deque
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+from indicators import TrendState, candles_to_array, batch_trend, rank_table
+from ratelimit import limiter, scheduler, resolve_priority, RESERVES, PRIORITY_POSITION
 
 BITVAVO_API_KEY = os.getenv("BITVAVO_API_KEY")
 BITVAVO_API_SECRET = os.getenv("BITVAVO_API_SECRET")
 BASE_URL = "https://api.bitvavo.com/v2"
+TELEGRAM_URL = "https://api.telegram.org"
+
+# 🌐 إعدادات اتصالات HTTP المشتركة
+HTTP_TIMEOUT = (float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)), float(os.getenv("HTTP_READ_TIMEOUT", 10)))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", 4))
+HTTP2 = os.getenv("HTTP2") == "1"
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# 🔗 جلسة واحدة بمسبح اتصالات keep-alive لكل مضيف
+def _make_session():
+    if HTTP2 and httpx is not None:
+        try:
+            return httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE + TELEGRAM_POOL_SIZE,
+                                    max_keepalive_connections=HTTP_POOL_SIZE + TELEGRAM_POOL_SIZE)
+            )
+        except ImportError:
+            print("⚠️ HTTP/2 يحتاج حزمة h2 - سيتم استخدام HTTP/1.1")
+    session = requests.Session()
+    session.mount(BASE_URL, HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+    session.mount(TELEGRAM_URL, HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE))
+    return session
+
+http = _make_session()
+
+# ✅ كل الطلبات الخارجية تمر من هنا (مع مهلة افتراضية)
+def http_request(method, url, timeout=HTTP_TIMEOUT, **kwargs):
+    if httpx is not None and isinstance(http, httpx.Client):
+        timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    return http.request(method, url, timeout=timeout, **kwargs)
 
 # ✅ توقيع معتمد من توتو
 def create_signature(timestamp, method, path, body=None):
@@ -16,8 +57,49 @@ def create_signature(timestamp, method, path, body=None):
     msg = f"{timestamp}{method}{path}{body_str}"
     return hmac.new(BITVAVO_API_SECRET.encode(), msg.encode(), hashlib.sha256).hexdigest()
 
+# 🚦 كل طلبات Bitvavo تمر من ميزانية الوزن المشتركة ثم مسار أولويتها
+def _bitvavo_call(method, url, weight=1, priority=None, **kwargs):
+    level = resolve_priority(priority, method)
+    limiter.acquire(weight, RESERVES[level])
+    with scheduler.lane(level):
+        response = http_request(method, url, **kwargs)
+    limiter.update(response.headers)
+    data = response.json()
+    if isinstance(data, dict) and data.get("errorCode") == 105:
+        limiter.ban(data)
+    return data
+
+# 🔌 نفس الطلب العام عبر WebSocket المفتوح (None للرجوع إلى REST)
+WS_RPC = os.getenv("WS_RPC", "1") == "1"
+
+def ws_request(action, options, weight=1, priority=None):
+    if not WS_RPC:
+        return None
+    from live_feed import rpc, rpc_ready
+    if not rpc_ready():
+        return None
+    level = resolve_priority(priority)
+    limiter.acquire(weight, RESERVES[level])
+    try:
+        with scheduler.lane(level):
+            result = rpc(action, options)
+    except Exception as e:
+        if getattr(e, "errorCode", None) == 105:
+            limiter.ban(e.response)
+            return None
+        print(f"⚠️ فشل طلب WebSocket {action}: {e}")
+        result = None
+    # الرجوع إلى REST سيحجز وزنه بنفسه، فلا نحسب نفس الطلب مرتين
+    if result is None:
+        limiter.refund(weight)
+    return result
+
+# ✅ طلب عام (بدون توقيع) بوزن معروف
+def public_request(path, weight=1, priority=None):
+    return _bitvavo_call("GET", BASE_URL + path, weight, priority)
+
 # ✅ طلب Bitvavo متكامل
-def bitvavo_request(method, path, body=None):
+def bitvavo_request(method, path, body=None, priority=None):
     timestamp = str(int(time.time() * 1000))
     signature = create_signature(timestamp, method, f"/v2{path}", body)
 
@@ -29,29 +111,253 @@ def bitvavo_request(method, path, body=None):
     }
 
     try:
-        response = requests.request(method, BASE_URL + path, headers=headers, json=body or {})
-        return response.json()
+        return _bitvavo_call(method, BASE_URL + path, priority=priority, headers=headers, json=body or {})
     except Exception as e:
         return {"error": str(e)}
 
-# ✅ جلب السعر الحالي
-def fetch_price(symbol):
+# 💶 كل أسعار السوق بطلب واحد (/ticker/price بلا market) مع كاش قصير مشترك
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", 3))
+BRIDGE_ASSETS = ("BTC", "ETH", "USDC", "USDT")
+_price_cache = {"time": 0, "prices": {}, "loading": None}
+_price_lock = threading.Lock()  # لحماية الكاش فقط، لا يُمسك أثناء الطلب
+
+# جلب واحد في كل مرة: من يصل أثناء جلب جارٍ ينتظر حدثه بدل تكرار الطلب
+def get_all_prices(max_age=PRICE_CACHE_TTL, priority=None):
+    with _price_lock:
+        if time.time() - _price_cache["time"] < max_age:
+            return _price_cache["prices"]
+        loading = _price_cache["loading"]
+        owner = loading is None
+        if owner:
+            loading = _price_cache["loading"] = threading.Event()
+
+    if not owner:
+        loading.wait()
+        with _price_lock:
+            return _price_cache["prices"]
+
     try:
-        url = f"{BASE_URL}/ticker/price?market={symbol}"
-        res = requests.get(url)
-        return float(res.json()["price"]) if res.status_code == 200 else None
+        data = public_request("/ticker/price", weight=2, priority=priority)
+        if not isinstance(data, list):
+            print("⚠️ فشل جلب الأسعار:", data)
+            with _price_lock:
+                return _price_cache["prices"]
+        prices = {}
+        for t in data:
+            try:
+                prices[t["market"]] = float(t["price"])
+            except (KeyError, TypeError, ValueError):
+                continue
+        with _price_lock:
+            _price_cache["time"] = time.time()
+            _price_cache["prices"] = prices
+        return prices
+    finally:
+        with _price_lock:
+            _price_cache["loading"] = None
+        loading.set()
+
+# 🌉 قيمة أصل باليورو: مباشرة عبر X-EUR أو عبر زوج وسيط مثل X-BTC × BTC-EUR
+def value_in_eur(asset, amount, prices):
+    if asset == "EUR":
+        return amount
+    if f"{asset}-EUR" in prices:
+        return amount * prices[f"{asset}-EUR"]
+    for bridge in BRIDGE_ASSETS:
+        if f"{asset}-{bridge}" in prices and f"{bridge}-EUR" in prices:
+            return amount * prices[f"{asset}-{bridge}"] * prices[f"{bridge}-EUR"]
+    return None
+
+# ✅ جلب السعر الحالي (من كاش الأسعار الجماعي إن كان حديثاً، دون انتظار جلب جارٍ)
+def fetch_price(symbol, priority=PRIORITY_POSITION):
+    with _price_lock:
+        if time.time() - _price_cache["time"] < PRICE_CACHE_TTL and symbol in _price_cache["prices"]:
+            return _price_cache["prices"][symbol]
+    try:
+        data = ws_request("getTickerPrice", {"market": symbol}, priority=priority) \
+            or public_request(f"/ticker/price?market={symbol}", priority=priority)
+        return float(data["price"]) if "price" in data else None
     except:
         return None
 
+# 🗃️ مخزن شموع محلي: (market, interval) -> حلقة شموع مرتبة زمنياً
+INTERVAL_MS = {
+    "1m": 60_000, "5m": 300_000, "15m": 900_000, "30m": 1_800_000,
+    "1h": 3_600_000, "2h": 7_200_000, "4h": 14_400_000, "6h": 21_600_000,
+    "8h": 28_800_000, "12h": 43_200_000, "1d": 86_400_000
+}
+CANDLE_IDLE_TTL = 600  # ثوانٍ قبل حذف سلسلة لم تُستخدم
+_candle_store = {}
+_candle_lock = threading.Lock()
+
+def _fetch_candles(symbol, interval, limit, start=None):
+    options = {"market": symbol, "interval": interval, "limit": limit}
+    if start is not None:
+        options["start"] = start
+    candles = ws_request("getCandles", options)
+    if isinstance(candles, list):
+        return candles
+
+    path = f"/{symbol}/candles?interval={interval}&limit={limit}"
+    if start is not None:
+        path += f"&start={start}"
+    return public_request(path)
+
+# 🕳️ شموع فاتت أثناء انقطاع WebSocket (تمر من ميزانية الوزن ومسارات الأولوية)
+def fetch_missed_candles(symbol, interval, start, limit=1440):
+    return _fetch_candles(symbol, interval, limit, start=start)
+
+# ➕ دمج الذيل الجديد (Bitvavo يعيد الأحدث أولاً)
+def _merge_tail(series, tail):
+    candles = series["candles"]
+    for c in reversed(tail):
+        if candles and c[0] == candles[-1][0]:
+            candles[-1] = c
+        elif not candles or c[0] > candles[-1][0]:
+            candles.append(c)
+        else:
+            continue
+        series["trend"].update(c)
+
 # ✅ جلب شموع
 def get_candles(symbol, interval="1m", limit=60):
-    url = f"{BASE_URL}/{symbol}/candles?interval={interval}&limit={limit}"
+    step = INTERVAL_MS.get(interval)
+    key = (symbol, interval)
     try:
-        response = requests.get(url)
-        return response.json()
+        with _candle_lock:
+            series = _candle_store.get(key)
+        now = time.time()
+
+        if step is None:
+            return _fetch_candles(symbol, interval, limit)
+
+        if series is not None and series["depth"] >= limit and now - series.get("pushed", 0) < step / 500:
+            pass  # السلسلة محدثة حياً عبر WebSocket
+        elif series is None or series["depth"] < limit or not series["candles"] \
+                or now * 1000 - series["candles"][-1][0] > step * series["depth"]:
+            data = _fetch_candles(symbol, interval, limit)
+            if not isinstance(data, list):
+                return data
+            series = {
+                "candles": deque(reversed(data), maxlen=limit),
+                "trend": TrendState.from_candles(data, limit),
+                "depth": limit,
+                "fetched": now
+            }
+        elif now - series["fetched"] >= step / 12000:
+            # نطلب فقط من آخر شمعة محفوظة (قد تكون ما زالت مفتوحة)
+            tail = _fetch_candles(symbol, interval, series["depth"], start=series["candles"][-1][0])
+            if not isinstance(tail, list):
+                return tail
+            with _candle_lock:
+                _merge_tail(series, tail)
+            series["fetched"] = now
+
+        series["used"] = now
+        with _candle_lock:
+            _candle_store[key] = series
+            window = list(series["candles"])[-limit:]
+        window.reverse()
+        return window
     except:
         return []
 
+# 📥 دمج شمعة وصلت من WebSocket في السلسلة المحفوظة
+def push_candle(symbol, interval, candle):
+    with _candle_lock:
+        series = _candle_store.get((symbol, interval))
+        if series is None or not series["candles"]:
+            return  # تُملأ أول مرة عبر REST
+        _merge_tail(series, [candle])
+        series["pushed"] = time.time()
+
+# 📈 مؤشرات الاتجاه من الحالة التراكمية للسلسلة (بدون إعادة حساب النافذة)
+# مؤشرات الحالة المحفوظة تُقرأ تحت القفل لأن خيط WebSocket يحدّثها في push_candle
+def _trend_metrics(symbol, interval, limit, candles):
+    if not isinstance(candles, list) or not candles:
+        return None
+    with _candle_lock:
+        series = _candle_store.get((symbol, interval))
+        if series is not None and series["depth"] == limit:
+            return series["trend"].snapshot()
+    return TrendState.from_candles(candles, limit).snapshot()
+
+# 📸 لقطة سوق لدورة واحدة: كل (market, interval) يُجلب مرة واحدة على الأكثر
+# الطلبات المتزامنة لنفس المفتاح تنتظر الجلب الجاري بدل تكراره (single-flight)
+# وكل المستهلكين يستلمون نفس الشموع ونفس مؤشرات الاتجاه (نسخة مجمدة، لا الحالة الحية)
+class MarketSnapshot:
+    def __init__(self):
+        self.created = time.time()
+        self._entries = {}
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def age(self):
+        return time.time() - self.created
+
+    def _entry(self, symbol, interval, limit):
+        key = (symbol, interval, limit)
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = {"ready": threading.Event(), "candles": []}
+                self._entries[key] = entry
+
+        if owner:
+            try:
+                candles = get_candles(symbol, interval=interval, limit=limit)
+                if isinstance(candles, list):
+                    entry["candles"] = candles
+            except Exception as e:
+                print(f"⚠️ فشل تحميل {symbol} {interval}:", e)
+            finally:
+                entry["ready"].set()
+        else:
+            entry["ready"].wait()
+        return entry
+
+    # شموع النافذة (الأحدث أولاً)، قائمة فارغة عند الفشل
+    def candles(self, symbol, interval="1m", limit=60):
+        return self._entry(symbol, interval, limit)["candles"]
+
+    # مؤشرات عملة واحدة من حالتها التراكمية، تُحسب مرة وتُجمد لبقية الدورة
+    def metrics(self, symbol, interval="1m", limit=60):
+        entry = self._entry(symbol, interval, limit)
+        with self._lock:
+            if "metrics" not in entry:
+                entry["metrics"] = _trend_metrics(symbol, interval, limit, entry["candles"])
+            return entry["metrics"]
+
+    def length(self, symbol, interval="1m", limit=60):
+        return len(self._entry(symbol, interval, limit)["candles"])
+
+    # 🧮 مصفوفة (symbols × candles × OHLCV) تُبنى مرة لكل مجموعة عملات في الدورة
+    def arrays(self, symbols, interval="1m", limit=60):
+        key = (tuple(symbols), interval, limit)
+        with self._lock:
+            cached = self._arrays.get(key)
+        if cached is None:
+            cached = candles_to_array([self.candles(s, interval, limit) for s in symbols], limit)
+            with self._lock:
+                cached = self._arrays.setdefault(key, cached)
+        return cached
+
+    # 🏁 تقييم كل العملات بتمريرة متجهة واحدة على مصفوفة اللقطة
+    def score(self, symbols, params, interval="1m", limit=60):
+        arr, lengths = self.arrays(symbols, interval, limit)
+        return rank_table(symbols, lengths, batch_trend(arr, lengths), params)
+
+# 🧹 حذف سلاسل العملات التي خرجت من الكون أو لم تُستخدم منذ مدة
+def prune_candle_store(keep_symbols=None):
+    now = time.time()
+    keep = set(keep_symbols) if keep_symbols is not None else None
+    with _candle_lock:
+        for key in list(_candle_store):
+            series = _candle_store[key]
+            if (keep is not None and key[0] not in keep) or now - series.get("used", 0) > CANDLE_IDLE_TTL:
+                del _candle_store[key]
+
 # ✅ حساب RSI
 def calculate_rsi(candles, period=14):
     closes = [float(c[4]) for c in candles]